@@ -0,0 +1,434 @@
+import argparse
+import contextlib
+import hashlib
+import heapq
+import json
+import math
+import os
+import random
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import tcpclient
+import tcpserver
+import udpclient
+import udpserver
+
+
+# runs the udp and tcp transfers on localhost through a relay which impairs the traffic in between,
+# for every protocol, object size and window size, and prints the measurements as json
+#
+#   python3 benchmark.py --sizes 65536 1048576 --windows 8 32 --loss 0.02 --delay 0.005 --repeat 5
+#
+# the udp relay applies loss, delay, jitter, duplication, reordering and corruption to the datagrams in both
+# directions, the tcp relay only delays the byte stream as the kernel hides the other impairments from the transfer
+
+SMALL_OBJECT_SIZE = 10 * 1024
+# object content is drawn from this alphabet so the objects are text like
+OBJECT_ALPHABET = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 \n"
+# time for the servers to bind before the first transfer
+SERVER_START_TIME = 0.3
+# kernel buffer sizes of the relay sockets, large enough to hold a window of jumbo datagrams
+RELAY_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+# decides what happens to a datagram passing the relay, the delays of the copies to deliver
+class Impairment(object):
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, duplicate=0.0, reorder=0.0, reorder_delay=0.005, corrupt=0.0, seed=None) -> None:
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        # a reordered datagram is held back by reorder_delay on top of its delay so the ones after it overtake it
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.corrupt = corrupt
+        self.random = random.Random(seed)
+    def apply(self, data):
+        if self.random.random() < self.loss:
+            return []
+        copies = 2 if self.random.random() < self.duplicate else 1
+        deliveries = []
+        for i in range(copies):
+            datagram = data
+            if datagram and self.random.random() < self.corrupt:
+                corrupted = bytearray(datagram)
+                corrupted[self.random.randrange(len(corrupted))] ^= 0xFF
+                datagram = bytes(corrupted)
+            delay = self.delay + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.reorder:
+                delay += self.reorder_delay
+            deliveries.append((delay, datagram))
+        return deliveries
+    # delay of the next piece of a byte stream
+    def stream_delay(self):
+        return self.delay + self.random.uniform(0, self.jitter)
+
+
+# calls the functions given to it after their delay, in order of their due time, from its own thread
+class DelayLine(object):
+    def __init__(self) -> None:
+        self.queue = []
+        self.count = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def call_later(self, delay, function, *args):
+        if delay <= 0:
+            function(*args)
+            return
+        with self.condition:
+            # the count keeps the calls with the same due time in order
+            heapq.heappush(self.queue, (time.perf_counter() + delay, self.count, function, args))
+            self.count += 1
+            self.condition.notify()
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.queue or self.queue[0][0] > time.perf_counter()):
+                    self.condition.wait(self.queue[0][0] - time.perf_counter() if self.queue else None)
+                if not self.running:
+                    return
+                due_time, count, function, args = heapq.heappop(self.queue)
+            try:
+                function(*args)
+            except OSError:
+                pass
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+def relay_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RELAY_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, RELAY_BUFFER_SIZE)
+    return sock
+
+
+# forwards the datagrams of every client to the target through a socket of its own, so the target sees
+# every client at its own address, and the answers back to the client
+class UdpRelay(object):
+    def __init__(self, target_address, impairment, listen_address=("127.0.0.1", 0)) -> None:
+        self.target_address = target_address
+        self.impairment = impairment
+        self.sock = relay_socket()
+        self.sock.bind(listen_address)
+        self.address = self.sock.getsockname()
+        # sockets towards the target by client address, and client addresses by socket
+        self.upstreams = {}
+        self.clients = {}
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.delay_line = DelayLine()
+        # traffic from the clients to the target before the impairments, and the datagrams the impairment dropped
+        # in both directions
+        self.bytes_up = 0
+        self.packets_up = 0
+        self.packets_dropped = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def upstream(self, client_address):
+        if client_address not in self.upstreams:
+            upstream = relay_socket()
+            upstream.bind(("127.0.0.1", 0))
+            self.upstreams[client_address] = upstream
+            self.clients[upstream] = client_address
+            self.selector.register(upstream, selectors.EVENT_READ)
+        return self.upstreams[client_address]
+    def run(self):
+        while self.running:
+            for key, events in self.selector.select(timeout=0.1):
+                try:
+                    data, addr = key.fileobj.recvfrom(65536)
+                except OSError:
+                    continue
+                if key.fileobj is self.sock:
+                    self.bytes_up += len(data)
+                    self.packets_up += 1
+                    self.forward(self.upstream(addr), data, self.target_address)
+                else:
+                    self.forward(self.sock, data, self.clients[key.fileobj])
+    def forward(self, sock, data, address):
+        deliveries = self.impairment.apply(data)
+        if not deliveries:
+            self.packets_dropped += 1
+        for delay, datagram in deliveries:
+            self.delay_line.call_later(delay, sock.sendto, datagram, address)
+    def reset_counters(self):
+        self.bytes_up = 0
+        self.packets_up = 0
+        self.packets_dropped = 0
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.delay_line.stop()
+        for sock in [self.sock, *self.upstreams.values()]:
+            sock.close()
+
+
+# forwards every accepted connection to the target over a connection of its own, the data keeps its order
+# and is delayed by the stream delay of the impairment
+class TcpRelay(object):
+    def __init__(self, target_address, impairment, listen_address=("127.0.0.1", 0)) -> None:
+        self.target_address = target_address
+        self.impairment = impairment
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(listen_address)
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.delay_line = DelayLine()
+        self.lock = threading.Lock()
+        self.bytes_up = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def run(self):
+        while True:
+            try:
+                client_socket, client_address = self.sock.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target_address)
+            threading.Thread(target=self.pump, args=(client_socket, upstream, True), daemon=True).start()
+            threading.Thread(target=self.pump, args=(upstream, client_socket, False), daemon=True).start()
+    # copies one direction of a connection, a piece is never sent before the one in front of it
+    def pump(self, source, destination, up):
+        release_time = 0
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b""
+            if up:
+                with self.lock:
+                    self.bytes_up += len(data)
+            now = time.perf_counter()
+            release_time = max(release_time, now + self.impairment.stream_delay())
+            # an empty piece closes the sending side of the destination after the data in front of it
+            self.delay_line.call_later(release_time - now, send_or_shutdown, destination, data)
+            if not data:
+                return
+    def reset_counters(self):
+        with self.lock:
+            self.bytes_up = 0
+    def stop(self):
+        self.sock.close()
+        self.delay_line.stop()
+
+
+def send_or_shutdown(sock, data):
+    if data:
+        sock.sendall(data)
+    else:
+        sock.shutdown(socket.SHUT_WR)
+
+
+# udp datagrams the kernel dropped on a full receive buffer on this host, at the relay or at the endpoints,
+# None where /proc/net/snmp is not available
+def udp_rcvbuf_errors():
+    try:
+        with open("/proc/net/snmp") as file:
+            names, values = [line.split() for line in file if line.startswith("Udp:")][:2]
+        return int(values[names.index("RcvbufErrors")])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# writes 10 large objects of the object size and 10 small ones with their .md5 files like generateobjects.sh
+def make_objects(directory, object_size, seed=0):
+    generator = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(10):
+        for kind, size in (("large", object_size), ("small", min(object_size, SMALL_OBJECT_SIZE))):
+            data = bytes(generator.choices(OBJECT_ALPHABET, k=size))
+            name = f"{kind}-{i}.obj"
+            with open(os.path.join(directory, name), "wb") as file:
+                file.write(data)
+            with open(os.path.join(directory, name + ".md5"), "w") as file:
+                file.write(f"{hashlib.md5(data).hexdigest()}  {name}\n")
+
+
+def file_md5(path):
+    object_hash = hashlib.md5()
+    with open(path, "rb") as file:
+        for piece in iter(lambda: file.read(1024 * 1024), b""):
+            object_hash.update(piece)
+    return object_hash.hexdigest()
+
+
+# checks that every object written below the output directory matches the source object
+def verify(objects_dir, output_dir, names):
+    written = {}
+    for directory, subdirectories, files in os.walk(output_dir):
+        for name in files:
+            written[name] = os.path.join(directory, name)
+    return all(name in written and file_md5(written[name]) == file_md5(os.path.join(objects_dir, name)) for name in names)
+
+
+# nearest rank percentile
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(times, payload_bytes, wire_bytes, retransmission_ratios, relay_drops, rcvbuf_errors, verified):
+    total_time = sum(times)
+    return {
+        "runs": len(times),
+        "completion_time_p50": percentile(times, 0.5),
+        "completion_time_p99": percentile(times, 0.99),
+        "throughput_bps": sum(wire_bytes) * 8 / total_time,
+        "goodput_bps": payload_bytes * len(times) * 8 / total_time,
+        "retransmission_ratio": sum(retransmission_ratios) / len(retransmission_ratios) if retransmission_ratios else None,
+        "relay_dropped": sum(relay_drops) if relay_drops else None,
+        "rcvbuf_errors": rcvbuf_errors,
+        "verified": verified,
+    }
+
+
+def run_udp(relay, objects_dir, output_root, window_size, args):
+    udpclient.server_address = relay.address
+    udpclient.objects_dir = objects_dir
+    udpclient.protocol_mode = args.udp_mode
+    udpserver.protocol_mode = args.udp_mode
+    udpclient.congestion_control = args.congestion_control
+    udpclient.stream_mode = args.stream_mode
+    udpclient.fec_mode = args.fec_mode
+    udpclient.fec_block_size = args.fec_block_size
+    udpclient.compression = args.compression
+    udpclient.path_mtu = args.path_mtu
+    udpclient.window_size = window_size
+    udpclient.MAX_WINDOW_SIZE = max(udpclient.MAX_WINDOW_SIZE, window_size)
+    # the receiver advertises its window in every ack, the sender never has more packets in flight
+    udpserver.window_size = max(udpserver.window_size, window_size)
+    times, wire_bytes, retransmission_ratios, relay_drops, verified = [], [], [], [], True
+    for run in range(args.repeat):
+        udpserver.output_dir = os.path.join(output_root, f"udp-{window_size}-{run}")
+        relay.reset_counters()
+        start = time.perf_counter()
+        stats = udpclient.gbn_sender()
+        times.append(time.perf_counter() - start)
+        wire_bytes.append(relay.bytes_up)
+        retransmission_ratios.append(stats["retransmissions"] / max(stats["packets_sent"], 1))
+        relay_drops.append(relay.packets_dropped)
+        names = [os.path.basename(path) for path, index in sum(udpclient.read_files(objects_dir), [])]
+        verified = verify(objects_dir, udpserver.output_dir, names) and verified
+    return times, wire_bytes, retransmission_ratios, relay_drops, verified
+
+
+def run_tcp(relay, objects_dir, output_root, window_size, args):
+    tcpclient.server_address = relay.address
+    tcpclient.objects_dir = objects_dir
+    tcpclient.max_unacked_objects = window_size
+    times, wire_bytes, verified = [], [], True
+    for run in range(args.repeat):
+        tcpserver.output_dir = os.path.join(output_root, f"tcp-{window_size}-{run}")
+        relay.reset_counters()
+        start = time.perf_counter()
+        tcpclient.main()
+        times.append(time.perf_counter() - start)
+        wire_bytes.append(relay.bytes_up)
+        names = [os.path.basename(path) for path in tcpclient.list_objects(objects_dir)]
+        verified = verify(objects_dir, tcpserver.output_dir, names) and verified
+    return times, wire_bytes, [], [], verified
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="udp and tcp transfer benchmark over an impairing relay")
+    parser.add_argument("--protocols", nargs="+", default=["udp", "tcp"], choices=["udp", "tcp"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[64 * 1024, 1024 * 1024], help="large object sizes in bytes")
+    parser.add_argument("--windows", nargs="+", type=int, default=[8, 32], help="udp window sizes and tcp unacknowledged object limits")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--udp-mode", default="gbn", choices=["gbn", "sr"])
+    parser.add_argument("--congestion-control", default="fixed", choices=sorted(udpclient.congestion_controls))
+    parser.add_argument("--stream-mode", default="single", choices=["single", "multi"])
+    parser.add_argument("--fec-mode", default="off", choices=["off", "fixed", "adaptive"])
+    parser.add_argument("--fec-block-size", type=int, default=8, help="udp packets per parity with --fec-mode fixed")
+    parser.add_argument("--compression", default="none", choices=["none", "zlib", "lzma"])
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--delay", type=float, default=0.0, help="one way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--duplicate", type=float, default=0.0)
+    parser.add_argument("--reorder", type=float, default=0.0)
+    parser.add_argument("--corrupt", type=float, default=0.0)
+    parser.add_argument("--path-mtu", type=int, help="udp path mtu, probed when not given")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="json file, printed when not given")
+    parser.add_argument("--verbose", action="store_true", help="keep the output of the transfers")
+    args = parser.parse_args(argv)
+    # the receiver keeps the packets of at most FEC_MAX_BLOCK_SIZE packets back for a rebuild
+    if not udpclient.FEC_MIN_BLOCK_SIZE <= args.fec_block_size <= udpclient.FEC_MAX_BLOCK_SIZE:
+        parser.error(f"--fec-block-size must be between {udpclient.FEC_MIN_BLOCK_SIZE} and {udpclient.FEC_MAX_BLOCK_SIZE}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    impairment = Impairment(args.loss, args.delay, args.jitter, args.duplicate, args.reorder, corrupt=args.corrupt, seed=args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir, open(os.devnull, "w") as devnull:
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+        with output:
+            relays = {}
+            if "udp" in args.protocols:
+                udpserver.server_address = ("127.0.0.1", free_port())
+                udpserver.serve_forever = True
+                threading.Thread(target=udpserver.gbn_receiver, daemon=True).start()
+                relays["udp"] = (UdpRelay(udpserver.server_address, impairment), run_udp)
+            if "tcp" in args.protocols:
+                tcpserver.server_address = ("127.0.0.1", free_port())
+                threading.Thread(target=tcpserver.main, daemon=True).start()
+                relays["tcp"] = (TcpRelay(tcpserver.server_address, impairment), run_tcp)
+            time.sleep(SERVER_START_TIME)
+
+            for object_size in args.sizes:
+                objects_dir = os.path.join(work_dir, f"objects-{object_size}")
+                make_objects(objects_dir, object_size, args.seed)
+                payload_bytes = sum(os.path.getsize(path) for path in tcpclient.list_objects(objects_dir))
+                for protocol, (relay, run) in relays.items():
+                    for window_size in args.windows:
+                        output_root = os.path.join(work_dir, f"received-{object_size}")
+                        errors_before = udp_rcvbuf_errors()
+                        times, wire_bytes, retransmission_ratios, relay_drops, verified = run(relay, objects_dir, output_root, window_size, args)
+                        errors_after = udp_rcvbuf_errors()
+                        rcvbuf_errors = errors_after - errors_before if protocol == "udp" and errors_before is not None and errors_after is not None else None
+                        # udp sends the objects without their .md5 files
+                        sent_bytes = payload_bytes if protocol == "tcp" else sum(os.path.getsize(os.path.join(objects_dir, name)) for name in os.listdir(objects_dir) if name.endswith(".obj"))
+                        result = {"protocol": protocol, "mode": args.udp_mode if protocol == "udp" else "pipelined", "object_size": object_size, "window_size": window_size}
+                        if protocol == "udp":
+                            result.update({"congestion_control": args.congestion_control, "stream_mode": args.stream_mode, "fec_mode": args.fec_mode, "fec_block_size": args.fec_block_size if args.fec_mode == "fixed" else None, "compression": args.compression})
+                        result.update(summarize(times, sent_bytes, wire_bytes, retransmission_ratios, relay_drops, rcvbuf_errors, verified))
+                        results.append(result)
+            for relay, run in relays.values():
+                relay.stop()
+
+    report = {
+        "impairment": {"loss": args.loss, "delay": args.delay, "jitter": args.jitter, "duplicate": args.duplicate, "reorder": args.reorder, "corrupt": args.corrupt, "seed": args.seed},
+        "path_mtu": args.path_mtu,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return report
+
+
+if __name__ == "__main__":
+    main()
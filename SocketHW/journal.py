@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+
+
+# the journal of a resumable transfer is kept in the directory the objects of the transfer are written to,
+# it holds an entry for every object by its file name with whether the object is complete, the offset
+# up to which its data is written and synced to disk and the md5 of the object as a hex digest, the md5
+# of the whole object the sender named in its manifest while the object is partial
+JOURNAL_NAME = "journal.json"
+# the journal is rewritten at most this often while the objects are written
+JOURNAL_INTERVAL = 0.5
+
+
+# reads the journal of the directory, entries whose file is missing or shorter than their offset are left out
+# so the objects are sent again from the start, a missing or damaged journal is empty
+def load(directory):
+    try:
+        with open(os.path.join(directory, JOURNAL_NAME)) as file:
+            entries = json.load(file)
+        journal = {}
+        for name, entry in entries.items():
+            path = os.path.join(directory, name)
+            if os.path.basename(name) == name and os.path.isfile(path) and os.path.getsize(path) >= entry["offset"]:
+                journal[name] = entry
+        return journal
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return {}
+
+
+# writes the journal next to the old one and replaces it, a crash leaves either the old or the new journal
+def save(directory, journal):
+    path = os.path.join(directory, JOURNAL_NAME)
+    with open(path + ".tmp", "w") as file:
+        json.dump(journal, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+# syncs the written data of an object file to disk and returns the offset it is written up to, the offset is
+# taken first so data written by another thread meanwhile is synced but not recorded
+def sync(file):
+    offset = file.tell()
+    file.flush()
+    os.fsync(file.fileno())
+    return offset
+
+
+# opens the object file to continue writing it at the offset, the data before it is read into the object hash
+# and the data after it, which was written after the last checkpoint, is cut off to be received again
+def reopen(path, offset, object_hash, buffer_size=1024 * 1024):
+    file = open(path, "r+b")
+    remaining = offset
+    while remaining > 0:
+        piece = file.read(min(remaining, buffer_size))
+        if not piece:
+            break
+        object_hash.update(piece)
+        remaining -= len(piece)
+    file.truncate(offset)
+    file.seek(offset)
+    return file
+
+
+def file_md5(path, buffer_size=1024 * 1024):
+    object_hash = hashlib.md5()
+    with open(path, "rb") as file:
+        for piece in iter(lambda: file.read(buffer_size), b""):
+            object_hash.update(piece)
+    return object_hash.hexdigest()
+
+
+# compares the manifest of the sender, the size and md5 hex digest of every object by file name, with the objects
+# in the directory and returns the offsets to send the missing, stale and partial objects from by file name
+# the entries of stale objects are dropped, an object without an entry whose file has the size in the manifest
+# is hashed once and recorded as complete if it matches
+def reconcile(directory, entries, manifest):
+    needed = {}
+    for name, (size, digest) in manifest.items():
+        entry = entries.get(name)
+        if entry is not None and entry.get("md5") != digest:
+            del entries[name]
+            entry = None
+        path = os.path.join(directory, name)
+        if entry is None and os.path.basename(name) == name and os.path.isfile(path) and os.path.getsize(path) == size and file_md5(path) == digest:
+            entry = entries[name] = {"done": True, "offset": size, "md5": digest}
+        if entry is None or not entry["done"]:
+            needed[name] = entry["offset"] if entry is not None else 0
+    return needed
@@ -0,0 +1,133 @@
+import json
+import math
+import sys
+import threading
+import time
+from collections import deque
+
+
+# counters, histograms and a trace of the last events shared by the udp and tcp scripts
+# everything is off by default, the calls return right away while enabled is False
+#
+#   import metrics
+#   metrics.enabled = True
+#   metrics.trace_size = 4096
+#   metrics.snapshot_interval = 1.0
+#
+# the snapshots are written as json lines to snapshot_file, stderr when it is None,
+# the last snapshot is written when the script stops and holds the trace
+enabled = False
+# number of events kept in the trace, the oldest ones are dropped, 0 to keep no trace
+trace_size = 0
+# seconds between snapshots, 0 to only write the last snapshot
+snapshot_interval = 0
+snapshot_file = None
+
+counters = {}
+histograms = {}
+# the events of the trace as (time, event, fields...), None while the trace is off
+events = None
+# the tcp server counts from many threads
+lock = threading.Lock()
+name = None
+stopped = threading.Event()
+snapshot_thread = None
+
+
+# power of two buckets, a value v > 0 is counted in the bucket e with 2 ** (e - 1) <= v < 2 ** e
+class Histogram(object):
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        bucket = math.frexp(value)[1] if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    # upper bound of the bucket holding the value at the rank, capped by the largest value
+    def percentile(self, fraction):
+        rank = max(math.ceil(fraction * self.count), 1)
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda bucket: -math.inf if bucket is None else bucket):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return 0 if bucket is None else min(2.0 ** bucket, self.max)
+        return self.max
+    def summary(self):
+        return {"count": self.count, "mean": self.total / self.count, "min": self.min, "max": self.max,
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99)}
+
+
+def count(counter, n=1):
+    if not enabled:
+        return
+    with lock:
+        counters[counter] = counters.get(counter, 0) + n
+
+
+def observe(histogram, value):
+    if not enabled:
+        return
+    with lock:
+        if histogram not in histograms:
+            histograms[histogram] = Histogram()
+        histograms[histogram].add(value)
+
+
+def trace(event, *fields):
+    if events is not None:
+        events.append((time.time(), event, *fields))
+
+
+def snapshot(with_trace=False):
+    with lock:
+        result = {"name": name, "time": time.time(), "counters": dict(counters),
+                  "histograms": {histogram: histograms[histogram].summary() for histogram in histograms}}
+    if with_trace and events is not None:
+        result["trace"] = list(events)
+    return result
+
+
+def write_snapshot(with_trace=False):
+    line = json.dumps(snapshot(with_trace)) + "\n"
+    if snapshot_file is None:
+        sys.stderr.write(line)
+        return
+    with open(snapshot_file, "a") as file:
+        file.write(line)
+
+
+def write_snapshots():
+    while not stopped.wait(snapshot_interval):
+        write_snapshot()
+
+
+# called by the scripts as they start, starts the trace and the periodic snapshots if metrics are enabled
+def start(script_name):
+    global name, events, snapshot_thread
+    if not enabled:
+        return
+    name = script_name
+    if trace_size > 0:
+        events = deque(maxlen=trace_size)
+    if snapshot_interval > 0 and snapshot_thread is None:
+        stopped.clear()
+        snapshot_thread = threading.Thread(target=write_snapshots, daemon=True)
+        snapshot_thread.start()
+
+
+# called by the scripts as they stop, writes the last snapshot with the trace
+def stop():
+    global snapshot_thread
+    if not enabled:
+        return
+    stopped.set()
+    if snapshot_thread is not None:
+        snapshot_thread.join()
+        snapshot_thread = None
+    write_snapshot(with_trace=True)
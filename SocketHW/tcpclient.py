@@ -1,9 +1,19 @@
 import socket
-import time
+import struct
 import os
+import hashlib
+import time
+import mmap
+import threading
+import tempfile
+import zlib
+import lzma
+from enum import IntEnum
+
+import metrics
 
-objects = []
 objects_dir = "/root/objects" # directory containing objects which client send
+server_address = ("172.17.0.2", 65432)
 
 # define the file order based on the specifie sequence
 file_order = [
@@ -16,49 +26,229 @@ file_order = [
 # exclude file:'generateobjects.sh'
 excluded_files = {'generateobjects.sh'}
 
-ordered_files = []
+# size of the pieces the objects are read and sent in without sendfile
+BUFFER_SIZE = 64 * 1024
+# send the file content with socket.sendfile, the kernel copies it from the page cache to the socket
+use_sendfile = True
+# "pipelined" sends the objects back to back with up to max_unacked_objects waiting for their acknowledgment,
+# "stop_and_wait" waits for the acknowledgment of every object before sending the next one
+send_mode = "pipelined"
+max_unacked_objects = 8
+# compression of the objects, "none", "zlib" or "lzma", an object is sent uncompressed
+# when a sample of it does not compress below COMPRESSION_MAX_RATIO of its size
+compression = "none"
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MAX_RATIO = 0.9
+# send the manifest of the objects before sending and only send the objects the server is missing
+# or holds stale copies of, the partial ones of an interrupted run are continued
+resume_transfers = True
+
+# codec of the object data in a frame
+class Compression(IntEnum):
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+
+# the client starts with the id of its transfer, all zeros when it does not resume, and the manifest of its objects:
+# the number of objects followed by an entry for each of them with the length of the object name, its size and md5 digest,
+# and the utf-8 name, the server answers with the number of objects to send followed by an entry for each of them
+# with the length of the object name and the offset to send it from, and the utf-8 name
+# the objects of the manifest which are not in the answer are held by the server and not sent
+TRANSFER_HEADER = struct.Struct('!16s')
+NO_TRANSFER_ID = bytes(TRANSFER_HEADER.size)
+MANIFEST_HEADER = struct.Struct('!I')
+MANIFEST_ENTRY = struct.Struct('!HQ16s')
+RESUME_HEADER = struct.Struct('!I')
+RESUME_ENTRY = struct.Struct('!HQ')
+# every object is sent as a frame, the header holds the length of the object name, the offset the data starts at,
+# the length of the object data as sent, the md5 digest of the whole uncompressed object and its compression,
+# followed by the utf-8 name and the data, only uncompressed objects are continued from an offset
+FRAME_HEADER = struct.Struct('!HQQ16sB')
+# acknowledgement of an object: its number on the connection and whether its digest matched
+OBJECT_ACK = struct.Struct('!I?')
+
+
+# lists the objects in the directory in sending order
+def list_objects(objects_dir):
+    ordered_files = []
+    for i in range(10):
+        for file_pattern in file_order:
+            file_name = file_pattern.format(i)
+            if file_name not in excluded_files:
+                file_path = os.path.join(objects_dir,file_name)
+                ordered_files.append(file_path)
+    return ordered_files
+
+# receives into the view until it is full or the connection is closed, returns the number of bytes received
+def recv_exact(client_socket, view):
+    received = 0
+    while received < len(view):
+        n = client_socket.recv_into(view[received:])
+        if n == 0:
+            break
+        received += n
+    return received
+
+# identifies the objects directory of the client across reconnects, the server keeps the objects of every transfer
+# in a directory of their own
+def transfer_id():
+    return hashlib.md5(f"{socket.gethostname()} {os.path.abspath(objects_dir)}".encode('utf-8')).digest()
+
+# the md5 digest of the object, read from its .md5 file if that is not older than the object
+def object_digest(file_path):
+    try:
+        if os.path.getmtime(file_path + ".md5") >= os.path.getmtime(file_path):
+            with open(file_path + ".md5") as file:
+                return bytes.fromhex(file.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        pass
+    object_hash = hashlib.md5()
+    with open(file_path, "rb") as file:
+        for piece in read_pieces(file):
+            object_hash.update(piece)
+    return object_hash.digest()
+
+# receives the struct and returns its fields, or raises ConnectionError if the connection is closed before it
+def recv_struct(client_socket, header):
+    data = bytearray(header.size)
+    if recv_exact(client_socket, memoryview(data)) < len(data):
+        raise ConnectionError("connection closed in the transfer header")
+    return header.unpack(data)
+
+# sends the transfer id and the manifest of the objects and returns the offset to send every object from by file name,
+# None for the objects the server holds, without resume_transfers the manifest is empty and every object is sent
+def negotiate_resume(client_socket, ordered_files):
+    if not resume_transfers:
+        ordered_files = []
+    manifest = [TRANSFER_HEADER.pack(transfer_id() if resume_transfers else NO_TRANSFER_ID), MANIFEST_HEADER.pack(len(ordered_files))]
+    for file_path in ordered_files:
+        name = os.path.basename(file_path).encode('utf-8')
+        manifest.append(MANIFEST_ENTRY.pack(len(name), os.path.getsize(file_path), object_digest(file_path)) + name)
+    client_socket.sendall(b"".join(manifest))
+    resume_state = {os.path.basename(file_path): None for file_path in ordered_files}
+    num_objects, = recv_struct(client_socket, RESUME_HEADER)
+    for i in range(num_objects):
+        name_length, offset = recv_struct(client_socket, RESUME_ENTRY)
+        name = bytearray(name_length)
+        if recv_exact(client_socket, memoryview(name)) < name_length:
+            raise ConnectionError("connection closed in the transfer header")
+        resume_state[name.decode('utf-8')] = offset
+    return resume_state
 
+# the objects still to be sent after resuming, with the offset to send each of them from
+def pending_objects(ordered_files, resume_state):
+    pending = []
+    for file_path in ordered_files:
+        offset = resume_state.get(os.path.basename(file_path), 0)
+        if offset is not None:
+            pending.append((file_path, offset))
+    return pending
 
-for i in range(10):
-    for file_pattern in file_order:
-        file_name = file_pattern.format(i)
-        if file_name not in excluded_files:
-            file_path = os.path.join(objects_dir,file_name)
-            ordered_files.append(file_path)
+# the objects are read in pieces to send them without sendfile
+def read_pieces(file):
+    return iter(lambda: file.read(BUFFER_SIZE), b"")
 
+# the codec of the object, from the compression setting and how well the start of the object compresses
+def choose_compression(file):
+    if compression == "none":
+        return Compression.NONE
+    sample = file.read(COMPRESSION_SAMPLE_SIZE)
+    file.seek(0)
+    if not sample or len(zlib.compress(sample, 1)) > len(sample) * COMPRESSION_MAX_RATIO:
+        return Compression.NONE
+    return Compression.LZMA if compression == "lzma" else Compression.ZLIB
 
-for file_path in ordered_files:
-    with open(file_path,"r") as file:
-        file_content = file.read()
-        objects.append(file_content)
+# compresses the file into a temporary file, the length of the compressed data goes into the frame header before it
+def compress_file(file, object_compression):
+    compressor = lzma.LZMACompressor() if object_compression == Compression.LZMA else zlib.compressobj()
+    compressed = tempfile.TemporaryFile()
+    for piece in read_pieces(file):
+        compressed.write(compressor.compress(piece))
+    compressed.write(compressor.flush())
+    compressed.seek(0)
+    return compressed
 
+# sends one object as a frame, the data from the offset on, a resumed object is sent uncompressed
+def send_object(client_socket, file_path, offset=0):
+    with open(file_path, "rb") as file:
+        data_length = os.fstat(file.fileno()).st_size
+        object_hash = hashlib.md5()
+        # the digest is taken from a memory map of the file, empty files can not be mapped
+        if data_length:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                object_hash.update(mapped)
+        object_compression = choose_compression(file) if offset == 0 else Compression.NONE
+        data = file if object_compression == Compression.NONE else compress_file(file, object_compression)
+        with data:
+            data_length = os.fstat(data.fileno()).st_size - offset
+            # send the frame header and the name, then the file content
+            name = os.path.basename(file_path).encode('utf-8')
+            client_socket.sendall(FRAME_HEADER.pack(len(name), offset, data_length, object_hash.digest(), object_compression) + name)
+            if use_sendfile:
+                client_socket.sendfile(data, offset, data_length)
+            else:
+                data.seek(offset)
+                for piece in read_pieces(data):
+                    client_socket.sendall(piece)
+    metrics.count("objects_sent")
+    metrics.count("bytes_sent", data_length)
 
-print("Number of files to be sent: {}".format(len(objects)))
+# reads the acknowledgments of the server while the objects are sent, every acknowledgment frees a slot
+# for the next object, if the connection is closed early all slots are freed and the sender is stopped
+# send_times holds the time every object started to be sent
+def receive_acks(client_socket, num_objects, slots, stopped, send_times):
+    acknowledgment = bytearray(OBJECT_ACK.size)
+    for i in range(num_objects):
+        if recv_exact(client_socket, memoryview(acknowledgment)) < len(acknowledgment):
+            print(f"Connection closed before the acknowledgment for object {i + 1}")
+            stopped.set()
+            for j in range(num_objects):
+                slots.release()
+            break
+        object_num, ok = OBJECT_ACK.unpack(acknowledgment)
+        metrics.count("acks_received")
+        if object_num < len(send_times):
+            metrics.observe("object_ack_time", time.time() - send_times[object_num])
+        if not ok:
+            print(f"md5 mismatch for object {object_num + 1}")
+            metrics.count("md5_mismatches")
+        slots.release()
 
-# function to send objects to the server
-def send_objects(client_socket, objects):
-    for i, obj in enumerate(objects):
-        # encode file content ( and null byte)
-        serialized_data = obj.encode('utf-8') + b"\x00"
-        #send serialized data to the server
-        time.sleep(1)
-        client_socket.sendall(serialized_data)
-        # wait for acknowledgment from the server
-        acknowledgment = client_socket.recv(1024)
-        print(f"Received acknowledgment for object {i + 1}: {acknowledgment.decode()}")
+# function to send objects to the server from their offsets, returns once all of them are acknowledged
+def send_objects(client_socket, ordered_files):
+    unacked_limit = max_unacked_objects if send_mode == "pipelined" else 1
+    slots = threading.Semaphore(unacked_limit)
+    stopped = threading.Event()
+    send_times = []
+    ack_reader = threading.Thread(target=receive_acks, args=(client_socket, len(ordered_files), slots, stopped, send_times), daemon=True)
+    ack_reader.start()
+    for file_path, offset in ordered_files:
+        # wait till less than unacked_limit objects are waiting for their acknowledgment
+        slots.acquire()
+        if stopped.is_set():
+            break
+        send_times.append(time.time())
+        send_object(client_socket, file_path, offset)
+    ack_reader.join()
 
 # main function to establish connection and send files
 def main():
         # create a tcp socket
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # connect to the server
-    client_socket.connect(("172.17.0.2", 65432))
+    client_socket.connect(server_address)
 
+    ordered_files = list_objects(objects_dir)
+    metrics.start("tcpclient")
+    # skip the objects the server already holds from an interrupted run
+    pending = pending_objects(ordered_files, negotiate_resume(client_socket, ordered_files))
+    print("Number of files to be sent: {} of {}".format(len(pending), len(ordered_files)))
     # send files to the server
-    send_objects(client_socket, objects)
+    send_objects(client_socket, pending)
         # close the socket
     client_socket.close()
     print("Client OK")
+    metrics.stop()
 
 if __name__ == "__main__":
     main()
@@ -1,84 +1,292 @@
 import socket
+import struct
 import time
+import os
+import hashlib
+import select
+import threading
+import zlib
+import lzma
+from enum import IntEnum
+from concurrent.futures import ThreadPoolExecutor
 
-def receive_objects(client_socket, num_objects):
+import journal
+import metrics
+
+
+server_address = ("0.0.0.0", 65432)
+# number of clients served at the same time, the connections beyond it wait in the listen backlog
+max_connections = 16
+LISTEN_BACKLOG = 128
+# the objects of every connection are saved in its own directory
+output_dir = "."
+# size of the receive buffer, the objects are written to their files in pieces of this size
+BUFFER_SIZE = 64 * 1024
+# acknowledgements are sent together once this many are pending, or earlier when the client has no more data in flight
+ack_batch_size = 16
+# directories of the transfers being received, a second connection of the same transfer at the same time
+# is not resumed and writes to a directory of its own
+active_transfers = set()
+active_transfers_lock = threading.Lock()
+
+# codec of the object data in a frame
+class Compression(IntEnum):
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+
+COMPRESSIONS = frozenset(Compression)
+
+# the client starts with the id of its transfer, all zeros when it does not resume, and the manifest of its objects:
+# the number of objects followed by an entry for each of them with the length of the object name, its size and md5 digest,
+# and the utf-8 name, the server answers with the number of objects to send followed by an entry for each of them
+# with the length of the object name and the offset to send it from, and the utf-8 name
+# the objects of the manifest which are not in the answer are held by the server and not sent
+TRANSFER_HEADER = struct.Struct('!16s')
+NO_TRANSFER_ID = bytes(TRANSFER_HEADER.size)
+MANIFEST_HEADER = struct.Struct('!I')
+MANIFEST_ENTRY = struct.Struct('!HQ16s')
+MAX_MANIFEST_ENTRIES = 65536
+RESUME_HEADER = struct.Struct('!I')
+RESUME_ENTRY = struct.Struct('!HQ')
+# every object is sent as a frame, the header holds the length of the object name, the offset the data starts at,
+# the length of the object data as sent, the md5 digest of the whole uncompressed object and its compression,
+# followed by the utf-8 name and the data, only uncompressed objects are continued from an offset
+FRAME_HEADER = struct.Struct('!HQQ16sB')
+# acknowledgement of an object: its number on the connection and whether its digest matched
+OBJECT_ACK = struct.Struct('!I?')
+
+# receives into the view until it is full or the connection is closed, returns the number of bytes received
+def recv_exact(client_socket, view):
+    received = 0
+    while received < len(view):
+        n = client_socket.recv_into(view[received:])
+        if n == 0:
+            break
+        received += n
+    return received
+
+def make_decompressor(compression):
+    if compression == Compression.ZLIB:
+        return zlib.decompressobj()
+    if compression == Compression.LZMA:
+        return lzma.LZMADecompressor()
+    return None
+
+# checks without blocking whether the client has sent more data
+def data_waiting(client_socket):
+    readable, _, _ = select.select([client_socket], [], [], 0)
+    return bool(readable)
+
+# records the offset the object file is written up to in the journal
+def checkpoint(directory, entries, file_name, output_file):
+    entries[file_name]["offset"] = journal.sync(output_file)
+    journal.save(directory, entries)
+
+# receives the objects of the client until it closes the connection, every object is written to its file
+# in the directory while it arrives and acknowledged when its digest is checked
+# the journal entries of a resumable transfer are updated as the objects are written, None otherwise,
+# and the objects are only continued from the offsets the client was told
+def receive_objects(client_socket, directory, entries=None, offsets=None):
+    os.makedirs(directory, exist_ok=True)
     received_objects = []
-    for i in range(num_objects*4):
-        print(f"Waiting for obj {i + 1}")
-        object_data = b""
-        # receive data in chuncks until a null byte is encountered
-        while True:
-            chunk = client_socket.recv(1024)
-            if not chunk:
-                break
-            object_data += chunk
-            if b"\x00" in chunk:
-                break
+    pending_acks = []
+    header = bytearray(FRAME_HEADER.size)
+    buffer = memoryview(bytearray(BUFFER_SIZE))
+    journal_time = time.time()
+    while True:
+        i = len(received_objects)
+        received = recv_exact(client_socket, memoryview(header))
+        if received == 0:
+            # the client closed the connection after its last object
+            break
+        if received < len(header):
+            print(f"Obj {i + 1} is incomplete, skipping...")
+            break
+        name_length, offset, data_length, digest, compression = FRAME_HEADER.unpack(header)
+        name = bytearray(name_length)
+        if recv_exact(client_socket, memoryview(name)) < name_length:
+            print(f"Obj {i + 1} is incomplete, skipping...")
+            break
+        # only the file name is used so the client can not write outside of the directory
+        file_name = os.path.basename(name.decode('utf-8'))
+        if file_name in ("", ".", "..", journal.JOURNAL_NAME, journal.JOURNAL_NAME + ".tmp"):
+            print(f"Obj {i + 1} has an invalid name, skipping...")
+            break
+        if compression not in COMPRESSIONS:
+            print(f"Obj {i + 1} has an unknown compression {compression}, skipping...")
+            break
+        # an object is only continued from the offset the server gave the client
+        if offset and (compression != Compression.NONE or offsets is None or offsets.get(file_name) != offset):
+            print(f"Obj {i + 1} has an invalid offset {offset}, skipping...")
+            break
+        decompressor = make_decompressor(compression)
+        start = time.time()
+        object_size = 0
 
-        try:
-                # decode the received object data
-            if object_data.strip(b"\x00"):
-                received_object = object_data.decode('utf-8').rstrip("\x00")
-                print(f"Obj {i + 1} received")
-                # append received object to the list
-                received_objects.append(received_object)
-                # send acknowledgment to the client
-                acknowledgment = f"Acknowledgment for object {i + 1}".encode()
-                client_socket.sendall(acknowledgment)
-            else:
-                print(f"Obj {i + 1} is empty or incomplete, skipping...")
-        except UnicodeDecodeError as e:
-            print(f"Error decoding obj {i + 1}: {e}")
-            acknowledgment = f"Error decoding obj {i + 1}: {e}".encode()
-            client_socket.sendall(acknowledgment)
+        # receive the data in pieces straight into the file, decompressing them on the way
+        object_hash = hashlib.md5()
+        remaining = data_length
+        file_path = os.path.join(directory, file_name)
+        if entries is not None:
+            entries[file_name] = {"done": False, "offset": offset, "md5": digest.hex()}
+        with journal.reopen(file_path, offset, object_hash) if offset else open(file_path, "wb") as output_file:
+            while remaining > 0:
+                piece = buffer[:min(remaining, BUFFER_SIZE)]
+                received = recv_exact(client_socket, piece)
+                data = piece[:received] if decompressor is None else decompressor.decompress(piece[:received])
+                object_hash.update(data)
+                output_file.write(data)
+                object_size += len(data)
+                remaining -= received
+                if received < len(piece):
+                    break
+                if entries is not None and compression == Compression.NONE and time.time() - journal_time > journal.JOURNAL_INTERVAL:
+                    checkpoint(directory, entries, file_name, output_file)
+                    journal_time = time.time()
+            if compression == Compression.ZLIB and remaining == 0:
+                data = decompressor.flush()
+                object_hash.update(data)
+                output_file.write(data)
+                object_size += len(data)
+            ok = remaining == 0 and object_hash.digest() == digest
+            if entries is not None:
+                # a compressed object is started over as the decompressor state is not kept, an object which
+                # does not match is sent again from the start
+                entries[file_name]["done"] = ok
+                if ok or (remaining > 0 and compression == Compression.NONE):
+                    checkpoint(directory, entries, file_name, output_file)
+                else:
+                    del entries[file_name]
+                    journal.save(directory, entries)
+        if remaining > 0:
+            print(f"Obj {i + 1} is incomplete, skipping...")
+            break
 
+        metrics.count("objects_received")
+        metrics.count("bytes_written", object_size)
+        metrics.observe("object_receive_time", time.time() - start)
+        metrics.trace("object_received", i, file_name, ok)
+        if not ok:
+            print(f"md5 of obj {i + 1} does not match")
+            metrics.count("md5_mismatches")
+        received_objects.append(file_name)
+        # send the acknowledgments to the client in batches, a client waiting for them has nothing in flight
+        pending_acks.append(OBJECT_ACK.pack(i, ok))
+        if len(pending_acks) >= ack_batch_size or not data_waiting(client_socket):
+            client_socket.sendall(b"".join(pending_acks))
+            metrics.observe("ack_batch", len(pending_acks))
+            pending_acks = []
+
+    if pending_acks:
+        client_socket.sendall(b"".join(pending_acks))
     return received_objects
 
-# function to save received objects to files
-def save_to_file(received_objects):
-        file_order = [
-                "large-{}.obj",
-                "small-{}.obj",
-                "large-{}.obj.md5",
-                "small-{}.obj.md5"
-        ]
+def connection_dir(client_address):
+    return os.path.join(output_dir, f"{client_address[0]}-{client_address[1]}")
+
+# the objects of a resumable transfer are written to a directory named by the transfer id instead of the port,
+# so a client which reconnects finds them again
+def transfer_dir(client_address, transfer_id):
+    return os.path.join(output_dir, f"{client_address[0]}-{transfer_id.hex()}")
+
+# receives the struct and returns its fields, or raises ConnectionError if the connection is closed before it
+def recv_struct(client_socket, header):
+    data = bytearray(header.size)
+    if recv_exact(client_socket, memoryview(data)) < len(data):
+        raise ConnectionError("connection closed in the transfer header")
+    return header.unpack(data)
+
+def recv_name(client_socket, name_length):
+    name = bytearray(name_length)
+    if recv_exact(client_socket, memoryview(name)) < name_length:
+        raise ConnectionError("connection closed in the transfer header")
+    return os.path.basename(name.decode('utf-8'))
 
-        ordered_files = []
+# answers the client with the objects to send and the offsets to send them from
+def send_offsets(client_socket, offsets):
+    reply = [RESUME_HEADER.pack(len(offsets))]
+    for name, offset in offsets.items():
+        name_bytes = name.encode('utf-8')
+        reply.append(RESUME_ENTRY.pack(len(name_bytes), offset) + name_bytes)
+    client_socket.sendall(b"".join(reply))
 
-        for i in range(10):
-                for file_pattern in file_order:
-                        file_name = file_pattern.format(i)
-                        ordered_files.append(file_name)
+# reads the transfer id and the manifest of the client and answers with the objects it has to send,
+# returns the directory of the objects, the journal entries, None if the client does not resume,
+# and the offsets the client was told
+def resume_transfer(client_socket, client_address):
+    transfer_id, = recv_struct(client_socket, TRANSFER_HEADER)
+    num_objects, = recv_struct(client_socket, MANIFEST_HEADER)
+    if num_objects > MAX_MANIFEST_ENTRIES:
+        raise ConnectionError(f"manifest of {num_objects} objects is too large")
+    manifest = {}
+    for i in range(num_objects):
+        name_length, size, digest = recv_struct(client_socket, MANIFEST_ENTRY)
+        manifest[recv_name(client_socket, name_length)] = (size, digest.hex())
+    directory = transfer_dir(client_address, transfer_id)
+    with active_transfers_lock:
+        in_use = transfer_id == NO_TRANSFER_ID or directory in active_transfers
+        if not in_use:
+            active_transfers.add(directory)
+    if in_use:
+        # every object is sent again to the directory of the connection
+        offsets = {name: 0 for name in manifest}
+        send_offsets(client_socket, offsets)
+        return connection_dir(client_address), None, offsets
+    entries = journal.load(directory)
+    offsets = journal.reconcile(directory, entries, manifest)
+    if os.path.isdir(directory):
+        journal.save(directory, entries)
+    send_offsets(client_socket, offsets)
+    print(f"transfer resumed: {len(manifest) - len(offsets)} of {len(manifest)} objects held")
+    return directory, entries, offsets
 
-        for i, obj in enumerate(received_objects):
-                file_name = ordered_files[i]
-                with open(file_name,"w") as output_file:
-                        output_file.write(obj)
+# receives the objects of one client, runs in a worker thread of the server
+def handle_connection(client_socket, client_address, slots):
+    print(f"Accepted connection from {client_address}")
+    start = time.time()
+    try:
+        # receive objects from the client and save them to files
+        directory, entries, offsets = resume_transfer(client_socket, client_address)
+        try:
+            received_objects = receive_objects(client_socket, directory, entries, offsets)
+        finally:
+            if entries is not None:
+                with active_transfers_lock:
+                    active_transfers.discard(directory)
+        print(f"Server OK: {client_address}, {len(received_objects)} objects")
+        end = time.time()
+        print(f"total download time tcp: {end - start}")
+    except Exception as e:
+        print(f"Unexpected error with {client_address}: {e}")
+    finally:
+        # close the client socket and free its slot for the next connection
+        client_socket.close()
+        slots.release()
 
 # main function to set up the server and handle connections
 def main():
         # create a tcp socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     # bind the socket to a specific address and port
-    server_socket.bind(("0.0.0.0", 65432))
-    # listen for incoming connections
-    server_socket.listen(1)
+    server_socket.bind(server_address)
+    # listen for incoming connections, bursts of clients queue up in the backlog
+    server_socket.listen(LISTEN_BACKLOG)
 
-    print("Server listening on port 65432")
-        #accept connections and process data
-    while True:
-        client_socket, client_address = server_socket.accept()
-        print(f"Accepted connection from {client_address}")
-        start = time.time()
-        num_objects = 10
-        # receive objects from the client
-        received_objects = receive_objects(client_socket, num_objects)
-                # save received objects to files
-        save_to_file(received_objects)
-                # close the client socket
-        client_socket.close()
-        print("Server OK")
-        end = time.time()
-        print(f"total download time tcp: {end - start}")
+    print(f"Server listening on port {server_address[1]}")
+    metrics.start("tcpserver")
+    slots = threading.BoundedSemaphore(max_connections)
+        #accept connections and process them in parallel, up to max_connections at a time
+    with ThreadPoolExecutor(max_workers=max_connections) as pool:
+        while True:
+            slots.acquire()
+            client_socket, client_address = server_socket.accept()
+            pool.submit(handle_connection, client_socket, client_address, slots)
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics.stop()
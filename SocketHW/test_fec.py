@@ -0,0 +1,62 @@
+import hashlib
+import os
+
+import udpclient
+import udpserver
+
+
+# the parity rebuild of a lost packet on the receiver
+#
+#   cd SocketHW && python3 -m pytest -q test_fec.py
+
+
+# sends the packets of an object with parities over a session, without the lost ones and with the late ones at the end,
+# and returns the written object and the next expected sequence number
+def receive_with_parity(tmp_path, monkeypatch, data, lost, protocol_mode, late=()):
+    monkeypatch.setattr(udpclient, "fec_mode", "fixed")
+    monkeypatch.setattr(udpclient, "fec_block_size", 4)
+    monkeypatch.setattr(udpclient, "compression", "none")
+    monkeypatch.setattr(udpserver, "output_dir", str(tmp_path))
+    monkeypatch.setattr(udpserver, "protocol_mode", protocol_mode)
+    os.makedirs(str(tmp_path), exist_ok=True)
+    path = os.path.join(str(tmp_path), "large-0.obj")
+    with open(path, "wb") as file:
+        file.write(data)
+    stats = {"retransmissions": 0, "packets_sent": 0}
+    packets = list(udpclient.add_parity(udpclient.prepare_object_packets(udpclient.DataType.LARGE, path, 0, 0, 0, 100), stats))
+    order = [packet for packet in packets if packet.packet_type == udpclient.PacketType.PARITY or packet.sequence_num not in lost | set(late)]
+    order += [packet for packet in packets if packet.packet_type != udpclient.PacketType.PARITY and packet.sequence_num in late]
+    session = udpserver.ReceiverSession(("127.0.0.1", 1))
+    # every datagram is received into the same buffer, as UdpReceiver.read_ready reuses its buffers for every batch
+    buffer = bytearray(udpserver.RECV_BUFFER_SIZE)
+    for packet in order:
+        datagram = packet.serialize()
+        buffer[:len(datagram)] = datagram
+        session.receive(udpserver.parse_packet(memoryview(buffer)[:len(datagram)]))
+    session.close()
+    with open(os.path.join(udpserver.session_dir(("127.0.0.1", 1)), "large-0.obj"), "rb") as file:
+        return file.read(), session.streams[0].expected_seq_num
+
+
+def test_parity_rebuilds_a_single_loss(tmp_path, monkeypatch):
+    data = os.urandom(950)
+    for protocol_mode in ("gbn", "sr"):
+        # the 10 data packets and the OBJECT_END, one lost in the second block
+        received, expected_seq_num = receive_with_parity(tmp_path / protocol_mode, monkeypatch, data, {5}, protocol_mode)
+        assert received == data
+        assert expected_seq_num == 11
+
+
+def test_parity_does_not_rebuild_two_losses(tmp_path, monkeypatch):
+    received, expected_seq_num = receive_with_parity(tmp_path, monkeypatch, os.urandom(950), {4, 6}, "sr")
+    assert expected_seq_num == 4
+    assert len(received) == 400
+
+
+def test_kept_parity_rebuilds_after_a_late_packet(tmp_path, monkeypatch):
+    data = os.urandom(950)
+    for protocol_mode in ("gbn", "sr"):
+        # the parity of the second block waits for 6, which arrives after the buffer held other datagrams
+        received, expected_seq_num = receive_with_parity(tmp_path / protocol_mode, monkeypatch, data, {4}, protocol_mode, late=[6])
+        assert hashlib.md5(received).digest() == hashlib.md5(data).digest()
+        assert expected_seq_num == 11
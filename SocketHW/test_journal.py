@@ -0,0 +1,59 @@
+import hashlib
+import os
+
+import journal
+
+
+# the resume journal
+#
+#   cd SocketHW && python3 -m pytest -q test_journal.py
+
+
+def write_object(path, data):
+    with open(path, "wb") as file:
+        file.write(data)
+    return len(data), hashlib.md5(data).hexdigest()
+
+
+def test_reconcile_keeps_complete_and_partial_and_drops_stale(tmp_path):
+    directory = str(tmp_path)
+    complete = write_object(os.path.join(directory, "large-0.obj"), b"a" * 100)
+    partial = (100, hashlib.md5(b"b" * 100).hexdigest())
+    write_object(os.path.join(directory, "large-1.obj"), b"b" * 40)
+    write_object(os.path.join(directory, "large-2.obj"), b"c" * 100)
+    stale = (100, hashlib.md5(b"changed" * 10).hexdigest())
+    untracked = write_object(os.path.join(directory, "small-0.obj"), b"d" * 10)
+    journal.save(directory, {
+        "large-0.obj": {"done": True, "offset": 100, "md5": complete[1]},
+        "large-1.obj": {"done": False, "offset": 32, "md5": partial[1]},
+        "large-2.obj": {"done": True, "offset": 100, "md5": hashlib.md5(b"c" * 100).hexdigest()},
+    })
+    entries = journal.load(directory)
+    manifest = {"large-0.obj": complete, "large-1.obj": partial, "large-2.obj": stale, "small-0.obj": untracked, "small-1.obj": (10, "0" * 32)}
+    needed = journal.reconcile(directory, entries, manifest)
+    assert needed == {"large-1.obj": 32, "large-2.obj": 0, "small-1.obj": 0}
+    assert "large-2.obj" not in entries
+    # a file without an entry which matches the manifest is recorded as complete
+    assert entries["small-0.obj"] == {"done": True, "offset": 10, "md5": untracked[1]}
+
+
+def test_load_drops_entries_beyond_the_file(tmp_path):
+    directory = str(tmp_path)
+    write_object(os.path.join(directory, "large-0.obj"), b"a" * 10)
+    journal.save(directory, {
+        "large-0.obj": {"done": False, "offset": 20, "md5": "0" * 32},
+        "large-1.obj": {"done": False, "offset": 0, "md5": "0" * 32},
+        "../large-2.obj": {"done": False, "offset": 0, "md5": "0" * 32},
+    })
+    assert journal.load(directory) == {}
+
+
+def test_reopen_hashes_the_prefix_and_cuts_the_rest(tmp_path):
+    path = os.path.join(str(tmp_path), "large-0.obj")
+    write_object(path, b"0123456789")
+    object_hash = hashlib.md5()
+    with journal.reopen(path, 4, object_hash) as file:
+        file.write(b"abc")
+    assert object_hash.digest() == hashlib.md5(b"0123").digest()
+    with open(path, "rb") as file:
+        assert file.read() == b"0123abc"
@@ -0,0 +1,16 @@
+import udpclient
+import udpserver
+
+
+# the 32 bit sequence numbers on the wire unwrapped to the sequence space of the sender and the receiver
+#
+#   cd SocketHW && python3 -m pytest -q test_sequence.py
+
+
+def test_unwrap_seq_across_the_wrap():
+    for module in (udpclient, udpserver):
+        assert module.unwrap_seq(0, module.SEQ_MODULO - 1) == module.SEQ_MODULO
+        assert module.unwrap_seq(module.SEQ_MASK, module.SEQ_MODULO + 2) == module.SEQ_MODULO - 1
+        for reference in (0, module.SEQ_MODULO - 3, 5 * module.SEQ_MODULO + 7):
+            for seq_num in range(reference - 1000, reference + 1000, 37):
+                assert module.unwrap_seq(seq_num & module.SEQ_MASK, reference) == seq_num
@@ -6,62 +6,219 @@ import os
 import hashlib
 import struct
 import hashlib
-from enum import Enum
+import zlib
+import lzma
+import mmap
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import IntEnum
+
+import metrics
 
 
 #constants 
+# initial retransmission timeout, afterwards it is calculated from the measured round trip times
 timeout = 0.5
+MIN_TIMEOUT = 0.05
+MAX_TIMEOUT = 4.0
 server_address = ("172.17.0.2", 65432)
+# window size of the "fixed" congestion control
 window_size = 25
+# "fixed", "aimd" (slow start and additive increase, multiplicative decrease) or "delay"
+congestion_control = "aimd"
+INITIAL_WINDOW_SIZE = 2
+MAX_WINDOW_SIZE = 256
+# the receiver reads datagrams into buffers of this size, enough for a 9000 byte jumbo frame
+MAX_DATAGRAM_SIZE = 9216
+# the packets are sized to fit the path mtu without ip fragmentation, None to probe it at the start
+path_mtu = None
+# the mtu every IPv4 path is assumed to carry, and the larger mtus probed in order till one is not answered
+BASE_MTU = 1280
+PROBE_MTUS = (1500, 4352, 9000)
+PROBE_ATTEMPTS = 2
+# IPv4 and UDP header sizes
+IP_UDP_OVERHEAD = 28
+# Linux value of IP_PMTUDISC_PROBE, sets don't fragment and ignores the cached path mtu
+IP_PMTUDISC_PROBE = 3
 MAX_RETRANSMISSIONS = 3
-timer_start_time = None
+# the acks waiting on the socket are received in batches of up to ACK_BATCH_SIZE into preallocated buffers
+ACK_BATCH_SIZE = 64
+ACK_BUFFER_SIZE = 1024
+# kernel socket buffer sizes, large enough to hold a full window burst
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# forward error correction, a PARITY packet after every block of packets lets the receiver rebuild
+# a single lost packet of the block without a retransmission
+# "off", "fixed" for blocks of fec_block_size packets, "adaptive" to size the blocks from the loss rate
+fec_mode = "off"
+fec_block_size = 8
+FEC_MIN_BLOCK_SIZE = 4
+# compression of the objects, "none", "zlib" or "lzma", an object is sent uncompressed
+# when a sample of it does not compress below COMPRESSION_MAX_RATIO of its size
+compression = "none"
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MAX_RATIO = 0.9
+# objects are read in pieces of this size to be compressed
+COMPRESSION_READ_SIZE = 64 * 1024
+# send the manifest of the objects before sending and only send the objects the receiver is missing
+# or holds stale copies of, the partial ones of an interrupted run are continued
+resume_transfers = True
+# worker processes hashing, checksumming and compressing the objects ahead of the window, 1 to prepare the packets
+# in the sending loop, the pool is only started when the data to send is at least PREPARE_POOL_MIN_BYTES
+prepare_workers = os.cpu_count() or 1
+PREPARE_POOL_MIN_BYTES = 16 * 1024 * 1024
+# the objects are prepared in ranges of about this size, rounded to whole packets, objects smaller than a range
+# are prepared in the sending loop
+PREPARE_RANGE_SIZE = 1024 * 1024
+# ranges of an object prepared or waiting in the pool per worker ahead of the one being sent
+PREPARE_AHEAD = 2
+# the deflate window, a range is compressed with the data of the window before it as dictionary
+ZLIB_WINDOW = 32 * 1024
+# zlib stream header of the default compression level, the pool writes the deflate stream between it
+# and the adler32 trailer
+ZLIB_HEADER = b"\x78\x9c"
+# "gbn" for Go-Back-N, "sr" for Selective Repeat
+protocol_mode = "gbn"
+# "single" sends all objects in one sequence space, "multi" sends every object in its own stream
+# with its own sequence space and window, up to max_active_streams objects at a time
+stream_mode = "single"
+max_active_streams = 8
+# window size limit of each stream in multi stream mode
+MAX_STREAM_WINDOW_SIZE = 64
 
 
 
 # file types
-class DataType(Enum):
+class DataType(IntEnum):
     SMALL = 0
     LARGE = 1
     
     
 # packet types
-class PacketType(Enum):
+class PacketType(IntEnum):
     SEND_PACKET = 0
     RESEND_PACKET = 1
     ACK = 2
     FIN = 3
     FIN_ACK = 4
-    
+    # sent after the data packets of an object, carries the md5 of the whole object
+    OBJECT_END = 5
+    # xor of a block of packets, takes no sequence number of its own and is not acknowledged
+    PARITY = 6
+    # sent by the sender before the data with the id of its transfer and the manifest of its objects, answered
+    # with the objects the receiver is missing or holds stale or partial copies of
+    RESUME = 7
+
+
+# checksum algorithms of the packet data, the receiver verifies each packet with the algorithm in its header
+# and answers with the same algorithm
+class ChecksumType(IntEnum):
+    MD5 = 0
+    CRC32 = 1
+
+
+# compression of the object data, every packet of an object carries the codec of the object in its header
+# and the receiver decompresses the data of the object in order while writing it
+class Compression(IntEnum):
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+
+
+checksum_type = ChecksumType.CRC32
+
+
+# the header fields are kept as plain integers in the packets, the enums are IntEnums so they compare equal to them
+DATA_TYPES = frozenset(DataType)
+PACKET_TYPES = frozenset(PacketType)
+CHECKSUM_TYPES = frozenset(ChecksumType)
+COMPRESSIONS = frozenset(Compression)
+
+
+# header fields: version, checksum type, data type, packet type, stream id, sequence number, checksum, file index, compression
+# the checksum field holds the raw md5 digest or the crc32 padded with zeros, see header_checksum
+# every stream has its own sequence space, stream 0 is used when all objects share one sequence space
+PROTOCOL_VERSION = 4
+HEADER_FORMAT = '!BBBBHI16sBB'
+HEADER = struct.Struct(HEADER_FORMAT)
+HEADER_SIZE = HEADER.size
+PACKET_TYPE_OFFSET = 3
+
+# sequence numbers are 32 bit on the wire and wrap around, both ends count them as unbounded integers
+# and map a received sequence number to the closest one around a reference (serial number arithmetic, RFC 1982)
+SEQ_MODULO = 1 << 32
+SEQ_MASK = SEQ_MODULO - 1
+
+# a RESUME packet of the sender holds the transfer id followed by the manifest entries of its objects:
+# data type, file index, size and md5 digest, the answer holds an entry for every object to send:
+# data type, file index and the offset to send it from, the objects missing in the manifest are always sent
+TRANSFER_ID_SIZE = 16
+MANIFEST_ENTRY = struct.Struct('!BBQ16s')
+RESUME_ENTRY = struct.Struct('!BBQ')
+# the manifest fits in a packet of the mtu every path carries
+MAX_MANIFEST_ENTRIES = (BASE_MTU - IP_UDP_OVERHEAD - HEADER_SIZE - TRANSFER_ID_SIZE) // MANIFEST_ENTRY.size
+
+
+def unwrap_seq(seq_num, reference):
+    return reference + ((seq_num - reference + SEQ_MODULO // 2) & SEQ_MASK) - SEQ_MODULO // 2
+
 
-    
 #packet structure, containing header information including checksum of data, type of packet, type of file, index of file from 0 to 9
 #as well as the sequence number
 class udp_packet(object):
-    def __init__(self, data_type: DataType, packet_type: PacketType, sequence_num: int, checksum: str, file_index: int, data: bytes) -> None:
+    __slots__ = ('data_type', 'raw_data', 'packet_type', 'sequence_num', 'checksum', 'checksum_type', 'file_index', 'stream_id', 'compression')
+    def __init__(self, data_type: DataType, packet_type: PacketType, sequence_num: int, checksum: bytes, file_index: int, data: bytes, checksum_type: ChecksumType = ChecksumType.MD5, stream_id: int = 0, compression: Compression = Compression.NONE) -> None:
         self.data_type = data_type
         self.raw_data = data
         self.packet_type = packet_type
         self.sequence_num = sequence_num
         self.checksum = checksum
+        self.checksum_type = checksum_type
         self.file_index = file_index
+        self.stream_id = stream_id
+        self.compression = compression
     # serializes the header into encoded structure
     def serialize(self):
         # Use struct.pack to serialize the fields into a binary string
-        return struct.pack('!BHH32sB', self.data_type.value, self.packet_type.value, self.sequence_num, self.checksum.encode('utf-8'), self.file_index) + self.raw_data
-    # unpacks and decodes the serialized packet
+        return HEADER.pack(PROTOCOL_VERSION, self.checksum_type, self.data_type, self.packet_type, self.stream_id, self.sequence_num & SEQ_MASK, header_checksum(self, self.checksum), self.file_index, self.compression) + self.raw_data
+    # serializes the packet into the buffer at the offset and returns its length
+    def serialize_into(self, buffer, offset):
+        HEADER.pack_into(buffer, offset, PROTOCOL_VERSION, self.checksum_type, self.data_type, self.packet_type, self.stream_id, self.sequence_num & SEQ_MASK, header_checksum(self, self.checksum), self.file_index, self.compression)
+        length = HEADER_SIZE + len(self.raw_data)
+        buffer[offset + HEADER_SIZE:offset + length] = self.raw_data
+        return length
+    # unpacks the header of the serialized packet, the data is a view into the serialized packet, not a copy
     @classmethod
     def deserialize(cls, data):
-        # Use struct.unpack to deserialize the binary string into fields
-        expected_length = struct.calcsize('!BHH32sB')
+        expected_length = HEADER_SIZE
         if len(data) < expected_length:
             raise ValueError(f"Insufficient data for deserialization. Expected {expected_length} bytes, got {len(data)} bytes.")
 
-        unpacked_data = struct.unpack(f'!BHH32sB{len(data) - expected_length}s', data[:])
-        data_type, packet_type, sequence_num, checksum_bytes, file_index, raw_data = unpacked_data
+        version, checksum_type, data_type, packet_type, stream_id, sequence_num, checksum, file_index, compression = HEADER.unpack_from(data)
+        if version != PROTOCOL_VERSION:
+            raise ValueError(f"Unsupported protocol version {version}")
+        if data_type not in DATA_TYPES or packet_type not in PACKET_TYPES or checksum_type not in CHECKSUM_TYPES or compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown data type {data_type}, packet type {packet_type}, checksum type {checksum_type} or compression {compression}")
 
-        checksum = checksum_bytes.decode('utf-8').rstrip('\x00')  # Remove null bytes if any
-        return cls(DataType(data_type), PacketType(packet_type), sequence_num, checksum, file_index, raw_data)
+        return cls(data_type, packet_type, sequence_num, checksum, file_index, memoryview(data)[HEADER_SIZE:], checksum_type, stream_id, compression)
     
+# a PARITY packet carries the xor of the records of a block of consecutive packets of a stream, its sequence number
+# is the first one of the block and its file index the number of packets in the block
+# a record is the data type, packet type, file index, compression and data length of a packet followed by its data,
+# shorter records are padded with zeros
+FEC_RECORD = struct.Struct('!BBBBH')
+FEC_MAX_BLOCK_SIZE = 64
+
+# a retransmitted packet has the same record as the first copy
+def fec_record(packet):
+    packet_type = PacketType.SEND_PACKET if packet.packet_type == PacketType.RESEND_PACKET else packet.packet_type
+    return FEC_RECORD.pack(packet.data_type, packet_type, packet.file_index, packet.compression, len(packet.raw_data)) + bytes(packet.raw_data)
+
+def xor_bytes(a, b):
+    length = max(len(a), len(b))
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(length, 'little')
+
 def chunk_data(data, chunk_size = 1024):
     # divide data into chunks
     chunk_list = []
@@ -71,190 +228,921 @@ def chunk_data(data, chunk_size = 1024):
 
 
 
-def calculate_checksum(data):
-    
-    md5_hash = hashlib.md5()
-    md5_hash.update(data)
-    checksum = md5_hash.hexdigest()
-    return checksum
+def calculate_checksum(data, checksum_type = ChecksumType.MD5):
+    # returns the checksum in the 16 bytes of the checksum field
+    if checksum_type == ChecksumType.CRC32:
+        return struct.pack('!I12x', zlib.crc32(data))
+    return hashlib.md5(data).digest()
+
+
+# the checksum on the wire covers the header as well, it is the checksum of the header fields other than the checksum
+# followed by the checksum of the data, a RESEND_PACKET is covered as a SEND_PACKET so a retransmission can rewrite
+# the packet type in place, packets are built with the checksum of their data and keep the one on the wire when received
+CHECKSUM_HEADER = struct.Struct('!BBBBHIBB')
+def header_checksum(packet, data_checksum):
+    packet_type = PacketType.SEND_PACKET if packet.packet_type == PacketType.RESEND_PACKET else packet.packet_type
+    header = CHECKSUM_HEADER.pack(PROTOCOL_VERSION, packet.checksum_type, packet.data_type, packet_type, packet.stream_id, packet.sequence_num & SEQ_MASK, packet.file_index, packet.compression)
+    return calculate_checksum(header + data_checksum, packet.checksum_type)
 
 
 def isCorrupted(data_packet):
-    # takes the serialized packet as input and checks each member 
-    # as well as the data for consistency
-    deserialized_packet = udp_packet.deserialize(data_packet)
-    data_type = deserialized_packet.data_type
-    packet_type = deserialized_packet.packet_type
-    sequence_num = deserialized_packet.sequence_num
-    checksum = deserialized_packet.checksum
-    raw_data = deserialized_packet.raw_data
-    if not isinstance(data_type, (DataType.LARGE.__class__, DataType.SMALL.__class__)):
-    # data type check
-        return True
-    if not isinstance(packet_type, (PacketType.ACK.__class__, PacketType.SEND_PACKET.__class__, PacketType.RESEND_PACKET.__class__, PacketType.FIN.__class__, PacketType.FIN_ACK.__class__)):
-    # packet type check
-        return True
-    if not isinstance(sequence_num, (int)):
-        #sequence number check
-        return True
-    # check wether the received checksum and the calculated checksum over raw_data are equal
-    if checksum != calculate_checksum(raw_data):
-        print(f"checksums are different for sequence number {sequence_num}")
-        print(f"expected checksum: {checksum}")
-        print(f"calculated checksum: {calculate_checksum(raw_data)}")
+    # takes the deserialized packet as input, the header fields are checked while deserializing,
+    # checks wether the received checksum and the one calculated over the header and raw_data are equal
+    calculated_checksum = header_checksum(data_packet, calculate_checksum(data_packet.raw_data, data_packet.checksum_type))
+    if data_packet.checksum != calculated_checksum:
+        metrics.trace("corrupted", data_packet.stream_id, data_packet.sequence_num)
         return True
     return False
 
 
+def parse_packet(data):
+    # parses a received datagram once, returns None if it is malformed or corrupted
+    try:
+        data_packet = udp_packet.deserialize(data)
+    except ValueError:
+        metrics.count("corrupted")
+        return None
+    if isCorrupted(data_packet):
+        metrics.count("corrupted")
+        return None
+    return data_packet
+
+
+
+
+
 
 
 
+# smoothed round trip time estimation and retransmission timeout calculation as in RFC 6298
+# only packets sent once are sampled, the acks of retransmitted packets are ambiguous (Karn's rule)
+class RttEstimator(object):
+    def __init__(self, initial_timeout=timeout, min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT) -> None:
+        self.srtt = None
+        self.rttvar = None
+        # timeout calculated from the samples, and the current timeout including the backoff
+        self.base_rto = initial_timeout
+        self.rto = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+    # updates the estimation with a new round trip time sample
+    def update(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.base_rto = min(max(self.srtt + 4 * self.rttvar, self.min_timeout), self.max_timeout)
+        self.rto = self.base_rto
+        metrics.observe("ack_rtt", sample)
+    # doubles the timeout after a retransmission, till a new sample is taken or the window moves forward
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.max_timeout)
+    def reset_backoff(self):
+        self.rto = self.base_rto
 
 
+# congestion controls size the window from the ack and loss feedback of the sender streams,
+# the window is shared by all streams as they use the same path
+# on_ack is called with the number of newly acknowledged packets and the round trip time sample if there is one,
+# on_loss when a hole is retransmitted before its timer expired, and on_timeout when a timer expired
+# the window is reduced once per round trip, the losses till recovery_end belong to the same congestion event
+class FixedWindow(object):
+    def __init__(self) -> None:
+        self.cwnd = window_size
+        self.ssthresh = window_size
+    def on_ack(self, acked, rtt_sample):
+        pass
+    def on_loss(self, now, rtt):
+        pass
+    def on_timeout(self, now, rtt):
+        pass
 
-def start_timer():
-    global timer_start_time
-    timer_start_time = time.time()
 
-def stop_timer():
-    global timer_start_time
-    if timer_start_time is not None:
-        elapsed_time = time.time() - timer_start_time
-        print(f"Timer stopped. Elapsed time: {elapsed_time} seconds")
-        timer_start_time = None
+class AimdWindow(FixedWindow):
+    def __init__(self) -> None:
+        self.cwnd = INITIAL_WINDOW_SIZE
+        self.ssthresh = MAX_WINDOW_SIZE
+        self.recovery_end = 0
+    def on_ack(self, acked, rtt_sample):
+        if self.cwnd < self.ssthresh:
+            # slow start, the window doubles every round trip
+            self.cwnd += acked
+        else:
+            # congestion avoidance, the window grows by one packet every round trip
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_WINDOW_SIZE)
+    def on_loss(self, now, rtt):
+        if now >= self.recovery_end:
+            self.ssthresh = max(self.cwnd / 2, INITIAL_WINDOW_SIZE)
+            self.cwnd = self.ssthresh
+            self.recovery_end = now + (rtt.srtt or rtt.rto)
+    def on_timeout(self, now, rtt):
+        self.ssthresh = max(self.cwnd / 2, INITIAL_WINDOW_SIZE)
+        self.cwnd = 1
+        self.recovery_end = now + (rtt.srtt or rtt.rto)
 
 
+# delay based congestion control in the style of TCP Vegas, the number of packets queued on the path
+# is estimated from the difference between the measured and the minimum round trip time
+# the window grows while less than DELAY_ALPHA packets are queued and shrinks when more than DELAY_BETA are
+DELAY_ALPHA = 2
+DELAY_BETA = 4
+class DelayBasedWindow(AimdWindow):
+    def __init__(self) -> None:
+        super().__init__()
+        self.min_rtt = None
+    def on_ack(self, acked, rtt_sample):
+        if rtt_sample is None:
+            return
+        if self.min_rtt is None or rtt_sample < self.min_rtt:
+            self.min_rtt = rtt_sample
+        queued = self.cwnd * (1 - self.min_rtt / rtt_sample)
+        if queued > DELAY_BETA:
+            # leave slow start and shrink the window by one packet every round trip
+            self.ssthresh = min(self.ssthresh, self.cwnd)
+            self.cwnd = max(self.cwnd - acked / self.cwnd, INITIAL_WINDOW_SIZE)
+        elif self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        elif queued < DELAY_ALPHA:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_WINDOW_SIZE)
+
+
+congestion_controls = {
+    "fixed": FixedWindow,
+    "aimd": AimdWindow,
+    "delay": DelayBasedWindow,
+}
+
+
+# cumulative ack and receive window at the start of the ack payload
+ACK_HEADER = struct.Struct('!IH')
+
+
+def parse_ack(ack_packet, base):
+    # the ack payload starts with the cumulative ack, the next sequence number the receiver expects,
+    # and the receive window, the number of packets it accepts from the cumulative ack on,
+    # followed by an optional bitmap of the packets it buffered above the cumulative ack
+    # bit i of the bitmap stands for the sequence number cumulative_ack + 1 + i
+    cumulative_ack, receive_window = ACK_HEADER.unpack_from(ack_packet.raw_data)
+    cumulative_ack = unwrap_seq(cumulative_ack, base)
+    bitmap = int.from_bytes(ack_packet.raw_data[ACK_HEADER.size:], 'little')
+    sacked = [cumulative_ack + 1 + i for i in range(bitmap.bit_length()) if bitmap >> i & 1]
+    return cumulative_ack, receive_window, sacked
+
+
+# the serialized packets of the window in one preallocated buffer, the packet with sequence number n
+# is serialized once into slot n % slots and sent from there on every (re)transmission
+# a slot is evicted when its packet is acknowledged or the window base moves past it,
+# as the window is never larger than the number of slots, a slot is always free when it is needed
+class PacketRing(object):
+    def __init__(self, slots=MAX_WINDOW_SIZE, slot_size=MAX_DATAGRAM_SIZE) -> None:
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = bytearray(slots * slot_size)
+        self.view = memoryview(self.buffer)
+        # views of the serialized packets and the sequence numbers stored in the slots
+        self.packets = [None] * slots
+        self.seq_nums = [None] * slots
+    def store(self, data_packet):
+        slot = data_packet.sequence_num % self.slots
+        if self.seq_nums[slot] is not None:
+            raise ValueError(f"Slot of sequence number {data_packet.sequence_num} is still used by {self.seq_nums[slot]}")
+        offset = slot * self.slot_size
+        length = data_packet.serialize_into(self.buffer, offset)
+        self.packets[slot] = self.view[offset:offset + length]
+        self.seq_nums[slot] = data_packet.sequence_num
+    def get(self, seq_num):
+        return self.packets[seq_num % self.slots]
+    # marks the stored data packet as retransmission, only the packet type byte of the header is changed
+    # OBJECT_END packets keep their type
+    def mark_resend(self, seq_num):
+        offset = seq_num % self.slots * self.slot_size + PACKET_TYPE_OFFSET
+        if self.buffer[offset] == PacketType.SEND_PACKET:
+            self.buffer[offset] = PacketType.RESEND_PACKET
+    def evict(self, seq_num):
+        slot = seq_num % self.slots
+        self.packets[slot] = None
+        self.seq_nums[slot] = None
+
+
+def send_packet(udp_socket, ring, seq_num, stats):
+    udp_socket.sendto(ring.get(seq_num), server_address)
+    stats["packets_sent"] += 1
+    metrics.count("packets_sent")
+
+
+def resend_packet(udp_socket, ring, seq_num, stats):
+    ring.mark_resend(seq_num)
+    udp_socket.sendto(ring.get(seq_num), server_address)
+    stats["packets_sent"] += 1
+    metrics.count("packets_sent")
+    stats["retransmissions"] += 1
+    metrics.count("retransmissions")
+
+
+# the usable window of all streams together is limited by the congestion window
+def window_limit(cc, stats):
+    stats["cwnd"] = cc.cwnd
+    stats["max_cwnd"] = max(stats["max_cwnd"], cc.cwnd)
+    return max(int(cc.cwnd), 1)
+
+
+# the parity blocks hold about one lost packet at the loss rate seen so far in adaptive mode
+def parity_block_size(stats):
+    if fec_mode != "adaptive":
+        return fec_block_size
+    if stats["retransmissions"] == 0:
+        return FEC_MAX_BLOCK_SIZE
+    loss_rate = stats["retransmissions"] / stats["packets_sent"]
+    return min(max(int(0.5 / loss_rate), FEC_MIN_BLOCK_SIZE), FEC_MAX_BLOCK_SIZE)
+
+
+def make_parity(block_start, count, parity, stream_id):
+    return udp_packet(DataType.SMALL, PacketType.PARITY, block_start, calculate_checksum(parity, checksum_type), count, parity, checksum_type, stream_id)
+
+
+# A generator which passes the packets of a stream through and follows every block of them with its PARITY packet
+def add_parity(data_packets, stats):
+    parity = b""
+    count = 0
+    for packet in data_packets:
+        yield packet
+        if count == 0:
+            block_start = packet.sequence_num
+            block_size = parity_block_size(stats)
+        parity = xor_bytes(parity, fec_record(packet))
+        count += 1
+        if count == block_size:
+            yield make_parity(block_start, count, parity, packet.stream_id)
+            parity = b""
+            count = 0
+    if count:
+        yield make_parity(block_start, count, parity, packet.stream_id)
+
+
+# sends the PARITY packets following a data packet, they take no sequence number and are never retransmitted
+def send_parity(udp_socket, stream, stats):
+    while stream.next_packet is not None and stream.next_packet.packet_type == PacketType.PARITY:
+        udp_socket.sendto(stream.next_packet.serialize(), server_address)
+        stats["parity_sent"] += 1
+        metrics.count("parity_sent")
+        stream.next_packet = next(stream.data_packets, None)
+
+
+# Go-Back-N stream: a single timer for the window base, the window slides forward on every cumulative ack
+# and on timeout every packet in the window that is not selectively acknowledged is sent again
+class GbnStream(object):
+    def __init__(self, stream_id, data_packets, slots=MAX_WINDOW_SIZE) -> None:
+        self.stream_id = stream_id
+        self.base = 0
+        self.next_seq_num = 0
+        self.receive_window = MAX_WINDOW_SIZE
+        # packets from the window base on, the packets are pulled from the packetizer when the window reaches them
+        # and evicted from the ring once the window base moves past them
+        self.ring = PacketRing(slots)
+        self.data_packets = data_packets
+        self.next_packet = next(data_packets, None)
+        # first send times of the packets in the window, retransmitted packets are removed to not take samples from them
+        self.send_times = {}
+        # packets above the window base reported in the sack bitmap of the receiver
+        self.sacked = set()
+        # holes retransmitted since the last timeout, each hole is fast retransmitted once
+        self.fast_retransmitted = set()
+        # start time of the timer of the window base, None while no packet is in flight
+        self.timer_start = None
+    def done(self):
+        return self.next_packet is None and self.base == self.next_seq_num
+    # the window of the stream is limited by the receive window and the size of the ring
+    def can_send(self):
+        return self.next_packet is not None and self.next_seq_num < self.base + min(self.receive_window, self.ring.slots)
+    def in_flight(self):
+        return self.next_seq_num - self.base
+    def send_next(self, udp_socket, stats):
+        self.ring.store(self.next_packet)
+        self.next_packet = next(self.data_packets, None)
+        send_packet(udp_socket, self.ring, self.next_seq_num, stats)
+        metrics.trace("send", self.stream_id, self.next_seq_num)
+        self.send_times[self.next_seq_num] = time.time()
+        if self.timer_start is None:
+            # if starting from the window base, set a timer
+            self.timer_start = time.time()
+        self.next_seq_num += 1
+        send_parity(udp_socket, self, stats)
+    def deadline(self, rtt):
+        if self.timer_start is None:
+            return None
+        return self.timer_start + rtt.rto
+    def on_ack(self, udp_socket, ack_packet, rtt, cc, stats):
+        rtt_sample = None
+        ack_seq_num = unwrap_seq(ack_packet.sequence_num, self.base)
+        if ack_seq_num in self.send_times:
+            rtt_sample = time.time() - self.send_times.pop(ack_seq_num)
+            rtt.update(rtt_sample)
+        cumulative_ack, self.receive_window, sack = parse_ack(ack_packet, self.base)
+        self.sacked.update(sack)
+        if cumulative_ack > self.base:
+            # slide the window forward and restart the timer for the new base
+            cc.on_ack(cumulative_ack - self.base, rtt_sample)
+            for seq_num in range(self.base, cumulative_ack):
+                self.send_times.pop(seq_num, None)
+                self.ring.evict(seq_num)
+            self.base = cumulative_ack
+            self.sacked = {seq_num for seq_num in self.sacked if seq_num >= self.base}
+            rtt.reset_backoff()
+            self.timer_start = time.time() if self.base < self.next_seq_num else None
+        # the holes below a selectively acknowledged packet are lost, resend them without waiting for the timeout
+        if self.sacked:
+            for seq_num in range(self.base, max(self.sacked)):
+                if seq_num not in self.sacked and seq_num not in self.fast_retransmitted:
+                    metrics.trace("fast_retransmit", self.stream_id, seq_num)
+                    cc.on_loss(time.time(), rtt)
+                    resend_packet(udp_socket, self.ring, seq_num, stats)
+                    self.send_times.pop(seq_num, None)
+                    self.fast_retransmitted.add(seq_num)
+    def on_timer(self, udp_socket, now, rtt, cc, stats):
+        if self.timer_start is None or now < self.timer_start + rtt.rto:
+            return
+        # Timeout occurred, retransmit the packets in the current window
+        metrics.count("timeouts")
+        metrics.trace("timeout", self.stream_id, self.base)
+        cc.on_timeout(now, rtt)
+        for seq_num in range(self.base, self.next_seq_num):
+            if seq_num not in self.sacked:
+                resend_packet(udp_socket, self.ring, seq_num, stats)
+                self.send_times.pop(seq_num, None)
+        self.fast_retransmitted.clear()
+        rtt.backoff()
+        self.timer_start = now
+
+
+# Selective Repeat stream: every packet has its own timer and is acknowledged by its own ack, by a cumulative ack
+# or by the sack bitmap, on timeout only the packets whose timer expired are sent again
+class SrStream(object):
+    def __init__(self, stream_id, data_packets, slots=MAX_WINDOW_SIZE) -> None:
+        self.stream_id = stream_id
+        self.base = 0
+        self.next_seq_num = 0
+        self.receive_window = MAX_WINDOW_SIZE
+        # packets which are not acknowledged yet, the packets are pulled from the packetizer when the window reaches them
+        # and evicted from the ring once they are acknowledged
+        self.ring = PacketRing(slots)
+        self.data_packets = data_packets
+        self.next_packet = next(data_packets, None)
+        # send times of the packets in the window which are not acknowledged yet
+        self.send_times = {}
+        # packets sent more than once, their acks are not used as round trip time samples
+        self.retransmitted = set()
+        # acknowledged packets above the window base
+        self.acked = set()
+        # holes retransmitted before their timer expired, each hole is fast retransmitted once per timer
+        self.fast_retransmitted = set()
+    def done(self):
+        return self.next_packet is None and self.base == self.next_seq_num
+    # the window of the stream is limited by the receive window and the size of the ring
+    def can_send(self):
+        return self.next_packet is not None and self.next_seq_num < self.base + min(self.receive_window, self.ring.slots)
+    def in_flight(self):
+        return len(self.send_times)
+    def send_next(self, udp_socket, stats):
+        self.ring.store(self.next_packet)
+        self.next_packet = next(self.data_packets, None)
+        send_packet(udp_socket, self.ring, self.next_seq_num, stats)
+        metrics.trace("send", self.stream_id, self.next_seq_num)
+        self.send_times[self.next_seq_num] = time.time()
+        self.next_seq_num += 1
+        send_parity(udp_socket, self, stats)
+    # the oldest timer in the window expires first
+    def deadline(self, rtt):
+        if not self.send_times:
+            return None
+        return min(self.send_times.values()) + rtt.rto
+    def on_ack(self, udp_socket, ack_packet, rtt, cc, stats):
+        rtt_sample = None
+        ack_seq_num = unwrap_seq(ack_packet.sequence_num, self.base)
+        if ack_seq_num in self.send_times and ack_seq_num not in self.retransmitted:
+            rtt_sample = time.time() - self.send_times[ack_seq_num]
+            rtt.update(rtt_sample)
+        cumulative_ack, self.receive_window, sack = parse_ack(ack_packet, self.base)
+        newly_acked = 0
+        for seq_num in [ack_seq_num, *range(self.base, cumulative_ack), *sack]:
+            if seq_num in self.send_times:
+                del self.send_times[seq_num]
+                self.ring.evict(seq_num)
+                self.retransmitted.discard(seq_num)
+                self.fast_retransmitted.discard(seq_num)
+                self.acked.add(seq_num)
+                newly_acked += 1
+        if newly_acked:
+            cc.on_ack(newly_acked, rtt_sample)
+        # slide the window over the acknowledged packets
+        if self.base in self.acked:
+            rtt.reset_backoff()
+        while self.base in self.acked:
+            self.acked.remove(self.base)
+            self.base += 1
+        # packets sent before an acknowledged one are lost, resend them without waiting for their timer
+        if self.acked:
+            highest_acked = max(self.acked)
+            now = time.time()
+            for seq_num in self.send_times:
+                if seq_num < highest_acked and seq_num not in self.fast_retransmitted:
+                    metrics.trace("fast_retransmit", self.stream_id, seq_num)
+                    cc.on_loss(now, rtt)
+                    resend_packet(udp_socket, self.ring, seq_num, stats)
+                    self.send_times[seq_num] = now
+                    self.retransmitted.add(seq_num)
+                    self.fast_retransmitted.add(seq_num)
+    # retransmit the packets whose timer expired
+    def on_timer(self, udp_socket, now, rtt, cc, stats):
+        expired = [seq_num for seq_num, sent_time in self.send_times.items() if now - sent_time >= rtt.rto]
+        if expired:
+            metrics.count("timeouts")
+            cc.on_timeout(now, rtt)
+            rtt.backoff()
+        for seq_num in expired:
+            metrics.trace("timeout", self.stream_id, seq_num)
+            resend_packet(udp_socket, self.ring, seq_num, stats)
+            self.send_times[seq_num] = now
+            self.retransmitted.add(seq_num)
+            self.fast_retransmitted.discard(seq_num)
+
+
+# waits up to the timeout for a datagram and receives it together with the ones already waiting behind it,
+# one datagram into each buffer, returns views of the received datagrams
+def receive_batch(udp_socket, buffers, timeout):
+    datagrams = []
+    udp_socket.settimeout(timeout)
+    for buffer in buffers:
+        try:
+            n, addr = udp_socket.recvfrom_into(buffer)
+        except (socket.timeout, BlockingIOError):
+            break
+        datagrams.append(memoryview(buffer)[:n])
+        udp_socket.setblocking(False)
+    return datagrams
+
+
+# drives the streams over one socket, up to max_active_streams streams are active at a time
+# and a new one starts when one of them is done
+# the streams take turns sending one packet each while the congestion window has room,
+# the acks are demultiplexed to the streams by their stream id
+def send_streams(udp_socket, streams, rtt, cc, stats):
+    streams = iter(streams)
+    ack_buffers = [bytearray(ACK_BUFFER_SIZE) for i in range(ACK_BATCH_SIZE)]
+    active = {}
+    turn = 0
+    while True:
+        while len(active) < max_active_streams:
+            stream = next(streams, None)
+            if stream is None:
+                break
+            active[stream.stream_id] = stream
+            stats["streams"] += 1
+        if not active:
+            break
+
+        # round robin over the active streams, starting with a different stream every turn
+        order = list(active.values())
+        order = order[turn % len(order):] + order[:turn % len(order)]
+        turn += 1
+        in_flight = sum(stream.in_flight() for stream in order)
+        limit = window_limit(cc, stats)
+        sending = True
+        while sending and in_flight < limit:
+            sending = False
+            for stream in order:
+                if in_flight >= limit:
+                    break
+                if stream.can_send():
+                    stream.send_next(udp_socket, stats)
+                    in_flight += 1
+                    sending = True
+        metrics.observe("window_occupancy", in_flight)
+
+        # wait for the acks until the first timer of the streams expires
+        deadlines = [deadline for deadline in (stream.deadline(rtt) for stream in order) if deadline is not None]
+        wait = min(deadlines) - time.time() if deadlines else rtt.rto
+        for ack_data in receive_batch(udp_socket, ack_buffers, max(wait, 0.001)):
+            # check for ack message corruption 
+            deserialized = parse_packet(ack_data)
+            # the empty ACK answering a late path mtu probe carries no cumulative ack and is skipped
+            if deserialized is not None and deserialized.packet_type == PacketType.ACK and deserialized.stream_id in active and len(deserialized.raw_data) >= ACK_HEADER.size:
+                metrics.count("acks_received")
+                active[deserialized.stream_id].on_ack(udp_socket, deserialized, rtt, cc, stats)
+
+        now = time.time()
+        for stream in order:
+            stream.on_timer(udp_socket, now, rtt, cc, stats)
+            if stream.done():
+                del active[stream.stream_id]
 
 
 objects_dir = "/root/objects"
-# A function to read the files with their file index, the file index is attached to the packet as it is sent, 
+# A function to list the files with their file index, the file index is attached to the packet as it is sent, 
 #to store the files in consistent order
+# the contents are not read here, prepare_packets reads them chunk by chunk while the packets are sent
 def read_files(objects_dir):
     files_large = []
     files_small = []
 
     for i, file_name in enumerate(os.listdir(objects_dir)):
         file_path = os.path.join(objects_dir, file_name)
-        with open(file_path, "r") as file:
-            file_content = file.read()
-            if "large" in file_name and "md5" not in file_name:
-                if "0" in file_name:
-                    files_large.append((file_content, 0))
-                elif "1" in file_name:
-                    files_large.append((file_content, 1))
-                elif "2" in file_name:
-                    files_large.append((file_content, 2))
-                elif "3" in file_name:
-                    files_large.append((file_content, 3))
-                elif "4" in file_name:
-                    files_large.append((file_content, 4))
-                elif "5" in file_name:
-                    files_large.append((file_content, 5))
-                elif "6" in file_name:
-                    files_large.append((file_content, 6))
-                elif "7" in file_name:
-                    files_large.append((file_content, 7))
-                elif "8" in file_name:
-                    files_large.append((file_content, 8))
-                elif "9" in file_name:
-                    files_large.append((file_content, 9))
-            elif "small" in file_name and "md5" not in file_name:
-                if "0" in file_name:
-                    files_small.append((file_content, 0))
-                elif "1" in file_name:
-                    files_small.append((file_content, 1))
-                elif "2" in file_name:
-                    files_small.append((file_content, 2))
-                elif "3" in file_name:
-                    files_small.append((file_content, 3))
-                elif "4" in file_name:
-                    files_small.append((file_content, 4))
-                elif "5" in file_name:
-                    files_small.append((file_content, 5))
-                elif "6" in file_name:
-                    files_small.append((file_content, 6))
-                elif "7" in file_name:
-                    files_small.append((file_content, 7))
-                elif "8" in file_name:
-                    files_small.append((file_content, 8))
-                elif "9" in file_name:
-                    files_small.append((file_content, 9))
-                #only appends the files not checksums
+        if "large" in file_name and "md5" not in file_name:
+            if "0" in file_name:
+                files_large.append((file_path, 0))
+            elif "1" in file_name:
+                files_large.append((file_path, 1))
+            elif "2" in file_name:
+                files_large.append((file_path, 2))
+            elif "3" in file_name:
+                files_large.append((file_path, 3))
+            elif "4" in file_name:
+                files_large.append((file_path, 4))
+            elif "5" in file_name:
+                files_large.append((file_path, 5))
+            elif "6" in file_name:
+                files_large.append((file_path, 6))
+            elif "7" in file_name:
+                files_large.append((file_path, 7))
+            elif "8" in file_name:
+                files_large.append((file_path, 8))
+            elif "9" in file_name:
+                files_large.append((file_path, 9))
+        elif "small" in file_name and "md5" not in file_name:
+            if "0" in file_name:
+                files_small.append((file_path, 0))
+            elif "1" in file_name:
+                files_small.append((file_path, 1))
+            elif "2" in file_name:
+                files_small.append((file_path, 2))
+            elif "3" in file_name:
+                files_small.append((file_path, 3))
+            elif "4" in file_name:
+                files_small.append((file_path, 4))
+            elif "5" in file_name:
+                files_small.append((file_path, 5))
+            elif "6" in file_name:
+                files_small.append((file_path, 6))
+            elif "7" in file_name:
+                files_small.append((file_path, 7))
+            elif "8" in file_name:
+                files_small.append((file_path, 8))
+            elif "9" in file_name:
+                files_small.append((file_path, 9))
+            #only appends the files not checksums
     return (files_small, files_large)
 
 
-# A function to prepare all the packets with their headers
-def prepare_packets(files_small, files_large):
-    data_packets = []
-    next_sequence_number = 0
+# reads a file in binary chunks from the start offset till the end offset, one chunk at a time as they are needed
+def read_chunks(file_path, chunk_size, start=0, end=None):
+    with open(file_path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        # empty files can not be mapped
+        if size == 0:
+            return
+        # the chunks are views into a memory map of the file, the map is released with the last view
+        mapped = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    end = size if end is None else min(end, size)
+    for offset in range(start, end, chunk_size):
+        yield mapped[offset:min(offset + chunk_size, end)]
+
+
+# a packet with the md5 of the whole object follows its data packets, as hex digest like in the .obj.md5 files,
+# so the receiver can verify the object once it is complete
+def make_object_end(data_type, file_index, stream_id, sequence_num, digest, object_compression):
+    data = digest.encode('utf-8')
+    return udp_packet(data_type, PacketType.OBJECT_END, sequence_num, calculate_checksum(data, checksum_type), file_index, data, checksum_type, stream_id, object_compression)
+
+
+# the codec of the object, from the compression setting and how well the start of the object compresses
+def choose_compression(file_path):
+    if compression == "none":
+        return Compression.NONE
+    with open(file_path, "rb") as file:
+        sample = file.read(COMPRESSION_SAMPLE_SIZE)
+    if not sample or len(zlib.compress(sample, 1)) > len(sample) * COMPRESSION_MAX_RATIO:
+        return Compression.NONE
+    return Compression.LZMA if compression == "lzma" else Compression.ZLIB
+
+
+def make_compressor(object_compression):
+    if object_compression == Compression.LZMA:
+        return lzma.LZMACompressor()
+    return zlib.compressobj()
+
+
+# A generator to hash the chunks of an object as they pass through
+def hash_chunks(chunks, object_hash):
+    for chunk in chunks:
+        object_hash.update(chunk)
+        yield chunk
+
+
+# A generator to compress the chunks of an object as one stream and cut the compressed data into chunks of chunk_size
+def compress_chunks(chunks, object_compression, chunk_size):
+    compressor = make_compressor(object_compression)
+    pending = bytearray()
+    for chunk in chunks:
+        pending += compressor.compress(chunk)
+        while len(pending) >= chunk_size:
+            yield bytes(pending[:chunk_size])
+            del pending[:chunk_size]
+    pending += compressor.flush()
+    for offset in range(0, len(pending), chunk_size):
+        yield bytes(pending[offset:offset + chunk_size])
+
+
+# the md5 hex digest of the whole object and its adler32 for the trailer of a zlib stream, runs in a worker process
+def digest_object(file_path):
+    object_hash = hashlib.md5()
+    adler = zlib.adler32(b"")
+    for chunk in read_chunks(file_path, COMPRESSION_READ_SIZE):
+        object_hash.update(chunk)
+        adler = zlib.adler32(chunk, adler)
+    return object_hash.hexdigest(), adler
+
+
+# the checksums of the packets of a range of an uncompressed object, runs in a worker process, the data of the packets
+# is cut from the memory map of the file again by the sender
+def checksum_range(file_path, start, end, chunk_size, object_checksum_type):
+    return None, [calculate_checksum(chunk, object_checksum_type) for chunk in read_chunks(file_path, chunk_size, start, end)]
+
+
+# compresses a range of the object into a part of one raw deflate stream, runs in a worker process
+# the range is compressed with the ZLIB_WINDOW bytes before it as dictionary and ends with a sync flush, so the parts
+# of all ranges joined are the deflate stream of the whole object, the last range ends the stream
+# returns the packet data cut from the part, the last packet of a range may be short, and their checksums
+def compress_range(file_path, start, end, chunk_size, object_checksum_type, last):
+    with open(file_path, "rb") as file:
+        file.seek(max(start - ZLIB_WINDOW, 0))
+        dictionary = file.read(start - max(start - ZLIB_WINDOW, 0))
+        data = file.read(end - start)
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS, zdict=dictionary) if dictionary else zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    part = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    chunks = [part[offset:offset + chunk_size] for offset in range(0, len(part), chunk_size)]
+    return chunks, [calculate_checksum(chunk, object_checksum_type) for chunk in chunks]
+
+
+# A generator to prepare the ranges of an object in the pool, up to PREPARE_AHEAD ranges per worker are submitted
+# ahead of the one the sender waits for, yields the results in order
+def prepare_ranges(pool, file_path, start, end, range_size, object_compression, chunk_size):
+    pending = deque()
+    offsets = iter(range(start, end, range_size))
+    while True:
+        while len(pending) < PREPARE_AHEAD * prepare_workers:
+            offset = next(offsets, None)
+            if offset is None:
+                break
+            range_end = min(offset + range_size, end)
+            if object_compression == Compression.NONE:
+                pending.append(pool.submit(checksum_range, file_path, offset, range_end, chunk_size, checksum_type))
+            else:
+                pending.append(pool.submit(compress_range, file_path, offset, range_end, chunk_size, checksum_type, range_end == end))
+        if not pending:
+            return
+        yield pending.popleft().result()
+
+
+# A generator to prepare the packets of an object from the ranges the pool prepares, the sender only waits for the
+# range of the next packet, the md5 of the object is computed by a worker of its own while the ranges are sent
+# a zlib object is sent as the zlib header, the deflate parts of the ranges and the adler32 trailer
+def prepare_pooled_packets(pool, data_type, file_path, file_index, stream_id, next_sequence_number, chunk_size, offset, object_compression):
+    digest_future = pool.submit(digest_object, file_path)
+    range_size = max(PREPARE_RANGE_SIZE // chunk_size, 1) * chunk_size
+    pieces = []
+    if object_compression == Compression.ZLIB:
+        pieces.append(([ZLIB_HEADER], [calculate_checksum(ZLIB_HEADER, checksum_type)]))
+    pieces = itertools.chain(pieces, prepare_ranges(pool, file_path, offset, os.path.getsize(file_path), range_size, object_compression, chunk_size))
+    if object_compression == Compression.NONE:
+        # the chunks of an uncompressed range line up with the packets as the ranges are whole packets
+        chunks = read_chunks(file_path, chunk_size, offset)
+    for range_chunks, checksums in pieces:
+        for i, checksum in enumerate(checksums):
+            chunk = next(chunks) if range_chunks is None else range_chunks[i]
+            yield udp_packet(data_type, PacketType.SEND_PACKET, next_sequence_number, checksum, file_index, chunk, checksum_type, stream_id, object_compression)
+            next_sequence_number += 1
+    digest, adler = digest_future.result()
+    if object_compression == Compression.ZLIB:
+        trailer = struct.pack("!I", adler)
+        yield udp_packet(data_type, PacketType.SEND_PACKET, next_sequence_number, calculate_checksum(trailer, checksum_type), file_index, trailer, checksum_type, stream_id, object_compression)
+        next_sequence_number += 1
+    yield make_object_end(data_type, file_index, stream_id, next_sequence_number, digest, object_compression)
+    return next_sequence_number + 1
+
+
+# A generator to prepare the packets of one object from the sequence number on, the data packets
+# followed by the OBJECT_END packet, returns the sequence number after the last packet
+# the md5 in the OBJECT_END packet is the one of the uncompressed object
+# a resumed object is sent uncompressed from the offset, the data before it is only hashed
+# with a pool the uncompressed and zlib objects larger than a range are prepared by its workers
+def prepare_object_packets(data_type, file_path, file_index, stream_id, next_sequence_number, chunk_size, offset=0, pool=None):
+    object_compression = choose_compression(file_path) if offset == 0 else Compression.NONE
+    if pool is not None and object_compression != Compression.LZMA and os.path.getsize(file_path) - offset > PREPARE_RANGE_SIZE:
+        return (yield from prepare_pooled_packets(pool, data_type, file_path, file_index, stream_id, next_sequence_number, chunk_size, offset, object_compression))
+    object_hash = hashlib.md5()
+    for chunk in read_chunks(file_path, COMPRESSION_READ_SIZE, 0, offset):
+        object_hash.update(chunk)
+    # each packet data is chunk_size bytes excluding the header size
+    if object_compression == Compression.NONE:
+        chunks = hash_chunks(read_chunks(file_path, chunk_size, offset), object_hash)
+    else:
+        chunks = compress_chunks(hash_chunks(read_chunks(file_path, COMPRESSION_READ_SIZE), object_hash), object_compression, chunk_size)
+    for chunk in chunks:
+        yield udp_packet(data_type, PacketType.SEND_PACKET, next_sequence_number, calculate_checksum(chunk, checksum_type), file_index, chunk, checksum_type, stream_id, object_compression)
+        next_sequence_number += 1
+    yield make_object_end(data_type, file_index, stream_id, next_sequence_number, object_hash.hexdigest(), object_compression)
+    return next_sequence_number + 1
+
+
+# waits till the deadline for the answer of the receiver with the packet type and sequence number,
+# other packets are skipped, returns None if it does not arrive
+def receive_reply(udp_socket, deadline, packet_type, sequence_num):
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        try:
+            udp_socket.settimeout(remaining)
+            reply_data, addr = udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+        except socket.timeout:
+            return None
+        reply = parse_packet(reply_data)
+        if reply is not None and reply.packet_type == packet_type and reply.sequence_num == sequence_num:
+            return reply
+
+
+# sends an ACK packet padded to the probed mtu and waits for the receiver to answer it,
+# the answer is an empty ACK packet with the probed mtu as its sequence number
+def send_probe(udp_socket, probe_mtu, rtt):
+    padding = bytes(probe_mtu - IP_UDP_OVERHEAD - HEADER_SIZE)
+    probe = udp_packet(DataType.SMALL, PacketType.ACK, probe_mtu, calculate_checksum(padding, checksum_type), 10, padding, checksum_type)
+    for attempt in range(PROBE_ATTEMPTS):
+        try:
+            udp_socket.sendto(probe.serialize(), server_address)
+        except OSError:
+            # larger than the mtu of the local interface
+            return False
+        sent_time = time.time()
+        if receive_reply(udp_socket, sent_time + rtt.rto, PacketType.ACK, probe_mtu) is not None:
+            if attempt == 0:
+                rtt.update(time.time() - sent_time)
+            return True
+    return False
+
+
+# identifies the objects directory of the sender across restarts, the receiver keeps the objects of every transfer
+# in a directory of their own
+def transfer_id():
+    return hashlib.md5(f"{socket.gethostname()} {os.path.abspath(objects_dir)}".encode('utf-8')).digest()
+
+
+# the md5 digest of the object, read from its .md5 file if that is not older than the object
+def object_digest(file_path):
+    try:
+        if os.path.getmtime(file_path + ".md5") >= os.path.getmtime(file_path):
+            with open(file_path + ".md5") as file:
+                return bytes.fromhex(file.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        pass
+    object_hash = hashlib.md5()
+    for chunk in read_chunks(file_path, COMPRESSION_READ_SIZE):
+        object_hash.update(chunk)
+    return object_hash.digest()
+
+
+# sends the manifest of the objects to the receiver and returns the offset to send every object of the manifest from
+# by data type and file index, None for the objects the receiver holds, the objects beyond MAX_MANIFEST_ENTRIES
+# and all objects when the receiver does not answer are sent from the start
+def negotiate_resume(udp_socket, objects, rtt):
+    manifest = [(data_type, file_index, os.path.getsize(file_path), object_digest(file_path)) for data_type, file_path, file_index in objects[:MAX_MANIFEST_ENTRIES]]
+    data = transfer_id() + b"".join(MANIFEST_ENTRY.pack(*entry) for entry in manifest)
+    request = udp_packet(DataType.SMALL, PacketType.RESUME, 0, calculate_checksum(data, checksum_type), 10, data, checksum_type)
+    for attempt in range(MAX_RETRANSMISSIONS):
+        udp_socket.sendto(request.serialize(), server_address)
+        reply = receive_reply(udp_socket, time.time() + rtt.rto, PacketType.RESUME, 0)
+        if reply is not None and len(reply.raw_data) % RESUME_ENTRY.size == 0:
+            rtt.reset_backoff()
+            resume_state = {(data_type, file_index): None for data_type, file_index, size, digest in manifest}
+            resume_state.update({(data_type, file_index): offset for data_type, file_index, offset in RESUME_ENTRY.iter_unpack(reply.raw_data)})
+            return resume_state
+        rtt.backoff()
+    print("resume not answered, sending every object")
+    return {}
+
+
+# the objects still to be sent after resuming, with the offset to send each of them from
+def pending_objects(objects, resume_state, stats):
+    pending = []
+    for data_type, file_path, file_index in objects:
+        offset = resume_state.get((data_type, file_index), 0)
+        if offset is None:
+            stats["objects_skipped"] += 1
+            continue
+        stats["bytes_skipped"] += offset
+        pending.append((data_type, file_path, file_index, offset))
+    return pending
+
+
+# packetization layer path mtu discovery (RFC 8899) before the transfer, the probes are sent with don't fragment
+# so a probe larger than the path mtu is dropped instead of fragmented, the largest answered probe is the path mtu
+def probe_path_mtu(udp_socket, rtt):
+    mtu = BASE_MTU
+    # without don't fragment every probe would arrive in fragments, the packets are sized to BASE_MTU
+    # unless path_mtu is set
+    try:
+        mtu_discover = udp_socket.getsockopt(socket.IPPROTO_IP, socket.IP_MTU_DISCOVER)
+        udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+    except (AttributeError, OSError):
+        print(f"path mtu: {mtu}, don't fragment is not available")
+        return mtu
+    for probe_mtu in PROBE_MTUS:
+        if not send_probe(udp_socket, probe_mtu, rtt):
+            break
+        mtu = probe_mtu
+    udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MTU_DISCOVER, mtu_discover)
+    print(f"path mtu: {mtu}")
+    return mtu
+
+
+# the objects in sending order, with their data type, path and file index
+def order_objects(files_small, files_large):
+    objects = []
     small_ind = 0
     large_ind = 0
     while small_ind < len(files_small) or large_ind < len(files_large):
         if large_ind < len(files_large):
         # shuffles through the small and large packets to send one large then one small object
-            large_file_index = files_large[large_ind][1]
-            # each packet data is 3072 byes excluding the header size 
-            chunks = chunk_data(files_large[large_ind][0], chunk_size = 3072)
+            objects.append((DataType.LARGE, *files_large[large_ind]))
             large_ind += 1
-            for chunk in chunks:
-                data_packets.append(udp_packet(DataType.LARGE, PacketType.SEND_PACKET, next_sequence_number, calculate_checksum(chunk.encode('utf-8')),large_file_index, chunk.encode('utf-8')))
-                next_sequence_number += 1
         if small_ind < len(files_small):
-            small_file_index = files_small[small_ind][1]
-            chunks = chunk_data(files_small[small_ind][0], chunk_size = 3072)
+            objects.append((DataType.SMALL, *files_small[small_ind]))
             small_ind += 1
-            for chunk in chunks:
-                data_packets.append(udp_packet(DataType.SMALL, PacketType.SEND_PACKET, next_sequence_number, calculate_checksum(chunk.encode('utf-8')), small_file_index,chunk.encode('utf-8')))
-                next_sequence_number += 1
-    return data_packets
+    return objects
+
+
+# A generator to prepare the packets of all objects in one sequence space, a packet is only read and built
+# when the sender pulls it into its window
+def prepare_packets(objects, chunk_size, pool=None):
+    next_sequence_number = 0
+    for data_type, file_path, file_index, offset in objects:
+        next_sequence_number = yield from prepare_object_packets(data_type, file_path, file_index, 0, next_sequence_number, chunk_size, offset, pool)
 
 
+# the pool preparing the objects, None when the packets are prepared in the sending loop, the workers are started
+# right away so they are up by the time the first object is sent
+def start_prepare_pool(objects):
+    if prepare_workers <= 1 or sum(os.path.getsize(file_path) for data_type, file_path, file_index in objects) < PREPARE_POOL_MIN_BYTES:
+        return None
+    # the workers are spawned, not forked, as the sender may run next to the threads of a receiver
+    pool = ProcessPoolExecutor(prepare_workers, mp_context=multiprocessing.get_context("spawn"))
+    for i in range(prepare_workers):
+        pool.submit(int)
+    return pool
+
 
 def gbn_sender():
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    base = 0
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
     #reading the files
     files_small, files_large = read_files(objects_dir)
-    #preparing the packets
-    data_packets = prepare_packets(files_small, files_large)
-    print(f"length of data packets {len(data_packets)}")
-    next_seq_num = 0
-    #iterates through the packets and sends them one by one
-    while base < len(data_packets):
-    #for sequence numbers within the current window size, send them over
-    #window size is 25
-        for i in range(base, min(base + window_size, len(data_packets))):
-            udp_socket.sendto(data_packets[i].serialize(), server_address)
-            test = udp_packet.deserialize(data_packets[i].serialize())
-            print(f"Sent packet with seq_num {i}")
-            if base == next_seq_num:
-            # if starting from the window base, set a timer
-                start_timer()
-                print(f"timer started for {base}")
-            next_seq_num += 1 
-
-        #after the window is all sent, wait for the ack messages
-        while True:
-            try:
-                # set a timeout for a socket to prevent blocking behavior
-                udp_socket.settimeout(timeout)
-                ack_data, addr = udp_socket.recvfrom(1024)
-                # check for ack message corruption 
-                if not isCorrupted(ack_data):
-                    deserialized = udp_packet.deserialize(ack_data)
-                    if (deserialized.sequence_num + 1 == next_seq_num):
-                        # if the ack for the end of the window is received, stop the timer  
-                        # and move to the next window
-                        base = next_seq_num
-                        stop_timer()
-                        break
-
-                    
-            except socket.timeout:
-                # Timeout occurred, retransmit the packets in the current window
-                print("Timeout occurred. Retransmitting packets.")
-                next_seq_num = base
-                break
+    metrics.start("udpclient")
+    # the same estimator is used for the data packets and the FIN handshake
+    rtt = RttEstimator()
+    cc = congestion_controls[congestion_control]()
+    stats = {"packets_sent": 0, "retransmissions": 0, "parity_sent": 0, "streams": 0, "cwnd": cc.cwnd, "max_cwnd": cc.cwnd}
+    objects = order_objects(files_small, files_large)
+    # the workers of the pool start while the path mtu is probed and the transfer resumed
+    pool = start_prepare_pool(objects)
+    stats["prepare_workers"] = prepare_workers if pool is not None else 0
+    try:
+        stats["path_mtu"] = path_mtu or probe_path_mtu(udp_socket, rtt)
+        stats["objects_skipped"] = 0
+        stats["bytes_skipped"] = 0
+        resume_state = negotiate_resume(udp_socket, objects, rtt) if resume_transfers else {}
+        objects = pending_objects(objects, resume_state, stats)
+        # the data of a packet fills the mtu after the ip, udp and packet headers, leaving room for the record header
+        # of the parity packets which are as large as the largest packet of their block
+        chunk_size = stats["path_mtu"] - IP_UDP_OVERHEAD - HEADER_SIZE - FEC_RECORD.size
+        stream_class = SrStream if protocol_mode == "sr" else GbnStream
+        with_parity = (lambda data_packets: add_parity(data_packets, stats)) if fec_mode != "off" else (lambda data_packets: data_packets)
+        #preparing the packets, they are built while the window moves forward
+        if stream_mode == "multi":
+            # every object in its own stream, stream 0 is left for the FIN message
+            streams = (stream_class(stream_id, with_parity(prepare_object_packets(data_type, file_path, file_index, stream_id, 0, chunk_size, offset, pool)), MAX_STREAM_WINDOW_SIZE)
+                       for stream_id, (data_type, file_path, file_index, offset) in enumerate(objects, 1))
+            send_streams(udp_socket, streams, rtt, cc, stats)
+            next_seq_num = 0
+        else:
+            stream = stream_class(0, with_parity(prepare_packets(objects, chunk_size, pool)), MAX_WINDOW_SIZE)
+            send_streams(udp_socket, [stream], rtt, cc, stats)
+            next_seq_num = stream.next_seq_num
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
     # after sending all the packets, sends the FIN message
     connection_open = True
     retransmissions = 0
@@ -263,16 +1151,17 @@ def gbn_sender():
             break
         data_bytes = b""
         file_index = 10
-        fin_packet = udp_packet(DataType.SMALL, PacketType.FIN, sequence_num=next_seq_num, checksum=calculate_checksum(data_bytes),file_index=file_index, data=data_bytes)
+        fin_packet = udp_packet(DataType.SMALL, PacketType.FIN, sequence_num=next_seq_num, checksum=calculate_checksum(data_bytes, checksum_type),file_index=file_index, data=data_bytes, checksum_type=checksum_type)
         udp_socket.sendto(fin_packet.serialize(), server_address)
         start_time = time.time()
         # if FIN_ACK was not recieved, it sends the FIN message 3 more times and closes the connection
         while retransmissions < MAX_RETRANSMISSIONS:
             try:
-                udp_socket.settimeout(timeout)
+                udp_socket.settimeout(max(start_time + rtt.rto - time.time(), 0.001))
                 ack_data, addr = udp_socket.recvfrom(1024)
-                data = udp_packet.deserialize(ack_data)
-                if not isCorrupted(ack_data):
+                data = parse_packet(ack_data)
+                # late acks of the data packets are skipped
+                if data is not None and data.packet_type == PacketType.FIN_ACK:
                     # stop_timer
                     print(f"fin ack received {data.packet_type}")
                     udp_socket.close()
@@ -281,6 +1170,7 @@ def gbn_sender():
                     break
             except socket.timeout:
                 retransmissions += 1
+                rtt.backoff()
                 print("Finish message not acknowledged, resending...")
                 break
             except Exception as e:
@@ -293,6 +1183,12 @@ def gbn_sender():
             print("Connection closed: client")
             connection_open = False
             break
+    stats["data_packets"] = stats["packets_sent"] - stats["retransmissions"]
+    stats["srtt"] = rtt.srtt
+    stats["rto"] = rtt.rto
+    print(f"sender stats: {stats}")
+    metrics.stop()
+    return stats
         
         
 
@@ -1,61 +1,167 @@
+import asyncio
 import socket
 import struct
 import time
 import os
 import hashlib
-import matplotlib.pyplot as plt
-import numpy as np
-from enum import Enum
+import zlib
+import lzma
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+
+import journal
+import metrics
 
 
 server_address = ("0.0.0.0", 65432)
-# list to store the received packets
-out_of_order_packs = []
+# "gbn" for Go-Back-N, "sr" for Selective Repeat
+protocol_mode = "gbn"
+# number of packets from the expected sequence number on accepted in Selective Repeat mode,
+# advertised to the sender in every ack as the receive window
+window_size = 64
+# attach a bitmap of the buffered packets to the acks so the sender learns about the holes
+sack_enabled = True
+# every sender gets a session keyed by its address, the objects of a session are written in its own directory
+output_dir = "."
+# sessions without a packet for this many seconds are dropped
+SESSION_IDLE_TIMEOUT = 30.0
+# keep receiving after a session is finished, otherwise stop after the first one
+serve_forever = True
+# sessions receiving the transfers by their directory, kept till their objects are written, a sender which restarts
+# on a new port takes its transfer over from the session it left behind
+active_transfers = {}
+# the datagrams waiting on the socket are received in batches of up to RECV_BATCH_SIZE into preallocated buffers,
+# the acks of a batch are coalesced to one ack per stream with the latest state
+RECV_BATCH_SIZE = 64
+# the largest datagram accepted, enough for a 9000 byte jumbo frame, larger path mtu probes are truncated and dropped
+RECV_BUFFER_SIZE = 9216
+# kernel socket buffer sizes, large enough to hold the bursts of several senders
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# worker threads decompressing, hashing and writing the objects, 0 to write them in the event loop
+verify_workers = os.cpu_count() or 1
+# chunks of a session handed to the workers and not written yet, the event loop waits for the workers beyond it
+WRITE_QUEUE_SIZE = 1024
 
 
 # file types
-class DataType(Enum):
+class DataType(IntEnum):
     SMALL = 0
     LARGE = 1
     
     
 # packet types
-class PacketType(Enum):
+class PacketType(IntEnum):
     SEND_PACKET = 0
     RESEND_PACKET = 1
     ACK = 2
     FIN = 3
     FIN_ACK = 4
+    # sent after the data packets of an object, carries the md5 of the whole object
+    OBJECT_END = 5
+    # xor of a block of packets, takes no sequence number of its own and is not acknowledged
+    PARITY = 6
+    # sent by the sender before the data with the id of its transfer and the manifest of its objects, answered
+    # with the objects the receiver is missing or holds stale or partial copies of
+    RESUME = 7
+
+
+# checksum algorithms of the packet data, the receiver verifies each packet with the algorithm in its header
+# and answers with the same algorithm
+class ChecksumType(IntEnum):
+    MD5 = 0
+    CRC32 = 1
+
+
+# compression of the object data, every packet of an object carries the codec of the object in its header
+# and the receiver decompresses the data of the object in order while writing it
+class Compression(IntEnum):
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+
+
+# the header fields are kept as plain integers in the packets, the enums are IntEnums so they compare equal to them
+DATA_TYPES = frozenset(DataType)
+PACKET_TYPES = frozenset(PacketType)
+CHECKSUM_TYPES = frozenset(ChecksumType)
+COMPRESSIONS = frozenset(Compression)
+
+
+# header fields: version, checksum type, data type, packet type, stream id, sequence number, checksum, file index, compression
+# the checksum field holds the raw md5 digest or the crc32 padded with zeros, see header_checksum
+# every stream has its own sequence space, stream 0 is used when all objects share one sequence space
+PROTOCOL_VERSION = 4
+HEADER_FORMAT = '!BBBBHI16sBB'
+HEADER = struct.Struct(HEADER_FORMAT)
+HEADER_SIZE = HEADER.size
+
+# sequence numbers are 32 bit on the wire and wrap around, both ends count them as unbounded integers
+# and map a received sequence number to the closest one around a reference (serial number arithmetic, RFC 1982)
+SEQ_MODULO = 1 << 32
+SEQ_MASK = SEQ_MODULO - 1
+
+# a RESUME packet of the sender holds the transfer id followed by the manifest entries of its objects:
+# data type, file index, size and md5 digest, the answer holds an entry for every object to send:
+# data type, file index and the offset to send it from, the objects missing in the manifest are always sent
+TRANSFER_ID_SIZE = 16
+MANIFEST_ENTRY = struct.Struct('!BBQ16s')
+RESUME_ENTRY = struct.Struct('!BBQ')
+
+
+def unwrap_seq(seq_num, reference):
+    return reference + ((seq_num - reference + SEQ_MODULO // 2) & SEQ_MASK) - SEQ_MODULO // 2
 
 
 #packet structure, containing header information including checksum of data, type of packet, type of file, index of file from 0 to 9
 #as well as the sequence number
 class udp_packet(object):
-    def __init__(self, data_type: DataType, packet_type: PacketType, sequence_num: int, checksum: str, file_index: int, data: bytes) -> None:
+    __slots__ = ('data_type', 'raw_data', 'packet_type', 'sequence_num', 'checksum', 'checksum_type', 'file_index', 'stream_id', 'compression')
+    def __init__(self, data_type: DataType, packet_type: PacketType, sequence_num: int, checksum: bytes, file_index: int, data: bytes, checksum_type: ChecksumType = ChecksumType.MD5, stream_id: int = 0, compression: Compression = Compression.NONE) -> None:
         self.data_type = data_type
         self.raw_data = data
         self.packet_type = packet_type
         self.sequence_num = sequence_num
         self.checksum = checksum
+        self.checksum_type = checksum_type
         self.file_index = file_index
+        self.stream_id = stream_id
+        self.compression = compression
     # serializes the header into encoded structure
     def serialize(self):
         # Use struct.pack to serialize the fields into a binary string
-        return struct.pack('!BHH32sB', self.data_type.value, self.packet_type.value, self.sequence_num, self.checksum.encode('utf-8'), self.file_index) + self.raw_data
-    # unpacks and decodes the serialized packet
+        return HEADER.pack(PROTOCOL_VERSION, self.checksum_type, self.data_type, self.packet_type, self.stream_id, self.sequence_num & SEQ_MASK, header_checksum(self, self.checksum), self.file_index, self.compression) + self.raw_data
+    # unpacks the header of the serialized packet, the data is a view into the serialized packet, not a copy
     @classmethod
     def deserialize(cls, data):
-        # Use struct.unpack to deserialize the binary string into fields
-        expected_length = struct.calcsize('!BHH32sB')
+        expected_length = HEADER_SIZE
         if len(data) < expected_length:
             raise ValueError(f"Insufficient data for deserialization. Expected {expected_length} bytes, got {len(data)} bytes.")
 
-        unpacked_data = struct.unpack(f'!BHH32sB{len(data) - expected_length}s', data[:])
-        data_type, packet_type, sequence_num, checksum_bytes, file_index, raw_data = unpacked_data
+        version, checksum_type, data_type, packet_type, stream_id, sequence_num, checksum, file_index, compression = HEADER.unpack_from(data)
+        if version != PROTOCOL_VERSION:
+            raise ValueError(f"Unsupported protocol version {version}")
+        if data_type not in DATA_TYPES or packet_type not in PACKET_TYPES or checksum_type not in CHECKSUM_TYPES or compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown data type {data_type}, packet type {packet_type}, checksum type {checksum_type} or compression {compression}")
 
-        checksum = checksum_bytes.decode('utf-8').rstrip('\x00')  # Remove null bytes if any
-        return cls(DataType(data_type), PacketType(packet_type), sequence_num, checksum, file_index, raw_data)
+        return cls(data_type, packet_type, sequence_num, checksum, file_index, memoryview(data)[HEADER_SIZE:], checksum_type, stream_id, compression)
     
+# a PARITY packet carries the xor of the records of a block of consecutive packets of a stream, its sequence number
+# is the first one of the block and its file index the number of packets in the block
+# a record is the data type, packet type, file index, compression and data length of a packet followed by its data,
+# shorter records are padded with zeros
+FEC_RECORD = struct.Struct('!BBBBH')
+FEC_MAX_BLOCK_SIZE = 64
+
+# a retransmitted packet has the same record as the first copy
+def fec_record(packet):
+    packet_type = PacketType.SEND_PACKET if packet.packet_type == PacketType.RESEND_PACKET else packet.packet_type
+    return FEC_RECORD.pack(packet.data_type, packet_type, packet.file_index, packet.compression, len(packet.raw_data)) + bytes(packet.raw_data)
+
+def xor_bytes(a, b):
+    length = max(len(a), len(b))
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(length, 'little')
+
 def chunk_data(data, chunk_size = 1024):
     # divide data into chunks
     chunk_list = []
@@ -65,161 +171,593 @@ def chunk_data(data, chunk_size = 1024):
 
 
 
-def calculate_checksum(data):
-    
-    md5_hash = hashlib.md5()
-    md5_hash.update(data)
-    checksum = md5_hash.hexdigest()
-    return checksum
+def calculate_checksum(data, checksum_type = ChecksumType.MD5):
+    # returns the checksum in the 16 bytes of the checksum field
+    if checksum_type == ChecksumType.CRC32:
+        return struct.pack('!I12x', zlib.crc32(data))
+    return hashlib.md5(data).digest()
+
+
+# the checksum on the wire covers the header as well, it is the checksum of the header fields other than the checksum
+# followed by the checksum of the data, a RESEND_PACKET is covered as a SEND_PACKET so a retransmission can rewrite
+# the packet type in place, packets are built with the checksum of their data and keep the one on the wire when received
+CHECKSUM_HEADER = struct.Struct('!BBBBHIBB')
+def header_checksum(packet, data_checksum):
+    packet_type = PacketType.SEND_PACKET if packet.packet_type == PacketType.RESEND_PACKET else packet.packet_type
+    header = CHECKSUM_HEADER.pack(PROTOCOL_VERSION, packet.checksum_type, packet.data_type, packet_type, packet.stream_id, packet.sequence_num & SEQ_MASK, packet.file_index, packet.compression)
+    return calculate_checksum(header + data_checksum, packet.checksum_type)
 
 
 def isCorrupted(data_packet):
-    # takes the serialized packet as input and checks each member 
-    # as well as the data for consistency
-    deserialized_packet = udp_packet.deserialize(data_packet)
-    data_type = deserialized_packet.data_type
-    packet_type = deserialized_packet.packet_type
-    sequence_num = deserialized_packet.sequence_num
-    checksum = deserialized_packet.checksum
-    raw_data = deserialized_packet.raw_data
-    if not isinstance(data_type, (DataType.LARGE.__class__, DataType.SMALL.__class__)):
-    # data type check
-        return True
-    if not isinstance(packet_type, (PacketType.ACK.__class__, PacketType.SEND_PACKET.__class__, PacketType.RESEND_PACKET.__class__, PacketType.FIN.__class__, PacketType.FIN_ACK.__class__)):
-    # packet type check
-        return True
-    if not isinstance(sequence_num, (int)):
-        #sequence number check
-        return True
-    # check wether the received checksum and the calculated checksum over raw_data are equal
-    if checksum != calculate_checksum(raw_data):
-        print(f"checksums are different for sequence number {sequence_num}")
-        print(f"expected checksum: {checksum}")
-        print(f"calculated checksum: {calculate_checksum(raw_data)}")
+    # takes the deserialized packet as input, the header fields are checked while deserializing,
+    # checks wether the received checksum and the one calculated over the header and raw_data are equal
+    calculated_checksum = header_checksum(data_packet, calculate_checksum(data_packet.raw_data, data_packet.checksum_type))
+    if data_packet.checksum != calculated_checksum:
+        metrics.trace("corrupted", data_packet.stream_id, data_packet.sequence_num)
         return True
     return False
 
-def gbn_receiver():
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.bind(server_address)
 
-    expected_seq_num = 0
-    print("server listening")
-
-
-    while True:
-        start_time = time.time()
-        # the data size is 3096 bytes and approximately one byte for the header. The receiver has a buffer of 4096
-        data_packet, addr = udp_socket.recvfrom(4096)
-        end_time = time.time()
-        #check for packet corruption
-        if not isCorrupted(data_packet):
-            packet = udp_packet.deserialize(data_packet)
-
-            # Check for packet duplication
-            if packet.sequence_num < expected_seq_num:
-                # duplicate packet is received, send an ack message and discard it. 
-                data = b""
-                ack_packet = udp_packet(data_type=DataType.SMALL, packet_type=PacketType.ACK, sequence_num=packet.sequence_num, checksum=calculate_checksum(data), file_index=10, data=data)
-                udp_socket.sendto(ack_packet.serialize(), addr)
-                continue
-
-            # Check if the received packet has the expected sequence number
-            # if the packet is data-containing packet
-            if packet.packet_type == PacketType.SEND_PACKET:
-                if packet.sequence_num == expected_seq_num:
-                    #store the packet for further processing
-                    out_of_order_packs.append(packet)
-                    data = b""
-                    #send a packet with ACK message
-                    ack_packet = udp_packet(data_type=DataType.SMALL, packet_type=PacketType.ACK, sequence_num=expected_seq_num, checksum=calculate_checksum(data), file_index=10, data=data)
-                    udp_socket.sendto(ack_packet.serialize(), addr)
-                    expected_seq_num += 1  # move the sequence number window forward
+def parse_packet(data):
+    # parses a received datagram once, returns None if it is malformed or corrupted
+    try:
+        data_packet = udp_packet.deserialize(data)
+    except ValueError:
+        metrics.count("corrupted")
+        return None
+    if isCorrupted(data_packet):
+        metrics.count("corrupted")
+        return None
+    return data_packet
+
+
+# state of the receiving side of a stream, every stream has its own sequence space
+class StreamReceiver(object):
+    def __init__(self) -> None:
+        self.expected_seq_num = 0
+        # packets received ahead of the expected sequence number in Selective Repeat mode
+        self.reorder_buffer = {}
+        # received packets by sequence number kept to rebuild a lost packet of their block from its parity
+        self.recent = {}
+        # parities of blocks with more than one missing packet, by the first sequence number of the block
+        self.parities = {}
+        # the packets below the end of the last rebuilt or complete block are not needed anymore
+        self.fec_resolved = 0
+
+
+# acknowledges the packet on the stream it was received on
+def make_ack(packet, stream):
+    # the ack payload starts with the cumulative ack, the next sequence number the receiver expects,
+    # and the receive window, followed by a bitmap of the buffered packets above it when sack is enabled
+    # bit i of the bitmap stands for the sequence number expected_seq_num + 1 + i
+    data = struct.pack('!IH', stream.expected_seq_num & SEQ_MASK, window_size)
+    if sack_enabled and stream.reorder_buffer:
+        bitmap = 0
+        for seq_num in stream.reorder_buffer:
+            bitmap |= 1 << (seq_num - stream.expected_seq_num - 1)
+        data += bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    return udp_packet(data_type=DataType.SMALL, packet_type=PacketType.ACK, sequence_num=packet.sequence_num, checksum=calculate_checksum(data, packet.checksum_type), file_index=10, data=data, checksum_type=packet.checksum_type, stream_id=packet.stream_id)
+
+def object_file_name(data_type, file_index):
+    if data_type == DataType.LARGE:
+        return f"large-{file_index}.obj"
+    return f"small-{file_index}.obj"
+
+
+def make_decompressor(compression):
+    if compression == Compression.ZLIB:
+        return zlib.decompressobj()
+    if compression == Compression.LZMA:
+        return lzma.LZMADecompressor()
+    return None
+
+
+# writes the data of the in-order packets straight into the object files as they arrive,
+# the files are keyed by data type and file index and closed at the OBJECT_END packet of the object,
+# where the md5 of the written data is compared with the one sent by the sender
+# with workers the chunks are decompressed, hashed and written by the worker the object was given when it was opened,
+# so the chunks of an object are handled in order and the objects of different streams on different cores
+# in a resumable transfer the complete objects and the offsets of the uncompressed objects being written
+# are checkpointed to the journal of the directory
+class ObjectWriter(object):
+    def __init__(self, directory=".", workers=None) -> None:
+        self.directory = directory
+        # open object files with the md5 of the data written into them so far, the decompressor of the object
+        # and its worker, an object is removed at its OBJECT_END packet and closed by its worker
+        self.files = {}
+        # single thread executors, None to write in the event loop
+        self.workers = workers
+        self.opened = 0
+        self.pending = threading.BoundedSemaphore(WRITE_QUEUE_SIZE)
+        # tasks of the writer handed to the workers and not done, the writer is closed by the worker running
+        # the last of them once close was called
+        self.queued = 0
+        self.queue_lock = threading.Lock()
+        self.closing = False
+        self.on_closed = None
+        # set once the files are closed and the journal is written
+        self.closed = threading.Event()
+        # journal entries by object file name, None while the transfer is not resumable,
+        # the workers update and save it as they finish the objects
+        self.journal = None
+        self.journal_lock = threading.Lock()
+        self.journal_time = 0
+        # the offsets the sender was told to send the objects from, and the md5 hex digests of its manifest, by key
+        self.offsets = {}
+        self.digests = {}
+    # continues the transfer whose objects are in the directory, the manifest holds the size and md5 hex digest
+    # of the objects of the sender by key, returns the offsets to send the missing, stale and partial objects from
+    def resume(self, directory, manifest):
+        self.directory = directory
+        self.journal = journal.load(directory)
+        keys = {object_file_name(*key): key for key in manifest}
+        needed = journal.reconcile(directory, self.journal, {object_file_name(*key): entry for key, entry in manifest.items()})
+        self.offsets = {keys[name]: offset for name, offset in needed.items()}
+        self.digests = {key: digest for key, (size, digest) in manifest.items()}
+        if os.path.isdir(directory):
+            journal.save(directory, self.journal)
+        return self.offsets
+    def open(self, key, compression):
+        os.makedirs(self.directory, exist_ok=True)
+        name = object_file_name(*key)
+        object_hash = hashlib.md5()
+        offset = self.offsets.pop(key, 0)
+        # an uncompressed object whose data was checkpointed is continued from the offset the sender was told
+        if offset and compression == Compression.NONE:
+            file = journal.reopen(os.path.join(self.directory, name), offset, object_hash)
+        else:
+            file = open(os.path.join(self.directory, name), "wb")
+        if self.journal is not None:
+            with self.journal_lock:
+                self.journal[name] = {"done": False, "offset": file.tell(), "md5": self.digests.get(key)}
+        worker = self.workers[self.opened % len(self.workers)] if self.workers else None
+        self.opened += 1
+        self.files[key] = (file, object_hash, compression, make_decompressor(compression), worker)
+    # runs the task in the worker, or right away without one
+    def submit(self, worker, task, *args):
+        if worker is None:
+            task(*args)
+            return
+        self.pending.acquire()
+        with self.queue_lock:
+            self.queued += 1
+        worker.submit(self.run, task, *args)
+    def run(self, task, *args):
+        try:
+            task(*args)
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+        finally:
+            self.pending.release()
+            with self.queue_lock:
+                self.queued -= 1
+                last = self.closing and self.queued == 0
+            if last:
+                self.finish_close()
+    def store(self, file, object_hash, data):
+        file.write(data)
+        object_hash.update(data)
+        metrics.count("bytes_written", len(data))
+    def write(self, entry, data):
+        file, object_hash, compression, decompressor, worker = entry
+        self.store(file, object_hash, data if decompressor is None else decompressor.decompress(data))
+    # the md5 of the object is complete with its last chunk and compared with the one the sender sent
+    def finish(self, key, entry, digest):
+        file, object_hash, compression, decompressor, worker = entry
+        if compression == Compression.ZLIB:
+            self.store(file, object_hash, decompressor.flush())
+        name = object_file_name(*key)
+        ok = object_hash.hexdigest() == digest
+        if self.journal is not None:
+            offset = journal.sync(file)
+            with self.journal_lock:
+                # an object which does not match is sent again from the start
+                if ok:
+                    self.journal[name].update(done=True, offset=offset, md5=digest)
                 else:
-                # packets larger than expected sequence number recieved, discard, and wait for client timeout event
-                    continue
-            # if it is of FIN type
-            else:
-                print(f"received packet with type :{packet.packet_type}")
-                data = b""
-                # prepare a FIN packet, send it to client, and close the socket
-                finAck_packet = udp_packet(data_type=DataType.SMALL, packet_type=PacketType.FIN_ACK, sequence_num=expected_seq_num, checksum=calculate_checksum(data),file_index=10, data=data)
-                udp_socket.sendto(finAck_packet.serialize(), addr)
-                udp_socket.close()
-                print("connection closed: server")
+                    del self.journal[name]
+                journal.save(self.directory, self.journal)
+        file.close()
+        metrics.trace("object_verified", name, ok)
+        if not ok:
+            print(f"md5 of {name} does not match")
+            metrics.count("md5_mismatches")
+    def deliver(self, packet):
+        key = (packet.data_type, packet.file_index)
+        if key not in self.files:
+            self.open(key, packet.compression)
+        entry = self.files[key]
+        worker = entry[4]
+        if packet.packet_type == PacketType.OBJECT_END:
+            del self.files[key]
+            self.submit(worker, self.finish, key, entry, bytes(packet.raw_data).decode('utf-8'))
+            return
+        # the data handed to a worker is copied out of the receive buffer which is reused for the next batch
+        self.submit(worker, self.write, entry, packet.raw_data if worker is None else bytes(packet.raw_data))
+        if self.journal is not None and time.time() - self.journal_time > journal.JOURNAL_INTERVAL:
+            self.checkpoint()
+    # records the offsets of the uncompressed objects being written and writes the journal,
+    # a compressed object is started over as the decompressor state is not kept
+    def checkpoint(self):
+        if self.journal is None:
+            return
+        with self.journal_lock:
+            for key, (file, object_hash, compression, decompressor, worker) in self.files.items():
+                if compression == Compression.NONE:
+                    self.journal[object_file_name(*key)]["offset"] = journal.sync(file)
+            os.makedirs(self.directory, exist_ok=True)
+            journal.save(self.directory, self.journal)
+        self.journal_time = time.time()
+    # closes the writer once the workers have written and verified everything it handed to them, without waiting
+    # for them, on_closed is called from the worker finishing the last task, or right away when there is none
+    # the writer is not used by the event loop after close
+    def close(self, on_closed=None):
+        self.on_closed = on_closed
+        with self.queue_lock:
+            self.closing = True
+            last = self.queued == 0
+        if last:
+            self.finish_close()
+    def finish_close(self):
+        try:
+            self.checkpoint()
+            for file, object_hash, compression, decompressor, worker in self.files.values():
+                file.close()
+            self.files = {}
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+        self.closed.set()
+        if self.on_closed is not None:
+            self.on_closed()
+
+
+def make_fin_ack(packet, sequence_num):
+    data = b""
+    return udp_packet(data_type=DataType.SMALL, packet_type=PacketType.FIN_ACK, sequence_num=sequence_num, checksum=calculate_checksum(data, packet.checksum_type),file_index=10, data=data, checksum_type=packet.checksum_type)
+
+
+# answers a path mtu probe of the sender, an ACK packet padded to the probed size, with an empty ACK packet
+# carrying the probed size as its sequence number
+def make_probe_ack(packet):
+    data = b""
+    return udp_packet(data_type=DataType.SMALL, packet_type=PacketType.ACK, sequence_num=packet.sequence_num, checksum=calculate_checksum(data, packet.checksum_type), file_index=10, data=data, checksum_type=packet.checksum_type, stream_id=packet.stream_id)
+
+
+def session_dir(addr):
+    return os.path.join(output_dir, f"{addr[0]}-{addr[1]}")
+
+
+# the objects of a resumable transfer are written to a directory named by the transfer id instead of the port,
+# so a restarted sender finds them again
+def transfer_dir(addr, transfer_id):
+    return os.path.join(output_dir, f"{addr[0]}-{transfer_id.hex()}")
+
+
+# answers the RESUME packet of the sender with the objects to send and their offsets
+def make_resume_reply(packet, offsets):
+    data = b"".join(RESUME_ENTRY.pack(data_type, file_index, offset) for (data_type, file_index), offset in offsets.items())
+    return udp_packet(data_type=DataType.SMALL, packet_type=PacketType.RESUME, sequence_num=packet.sequence_num, checksum=calculate_checksum(data, packet.checksum_type), file_index=10, data=data, checksum_type=packet.checksum_type)
+
+
+# rebuilds a packet from the xor of its record with the records of the other packets of its block
+def packet_from_record(record, sequence_num, parity):
+    data_type, packet_type, file_index, compression, length = FEC_RECORD.unpack_from(record)
+    if data_type not in DATA_TYPES or packet_type not in (PacketType.SEND_PACKET, PacketType.RESEND_PACKET, PacketType.OBJECT_END) or compression not in COMPRESSIONS:
+        return None
+    data = record[FEC_RECORD.size:FEC_RECORD.size + length]
+    return udp_packet(data_type, packet_type, sequence_num, calculate_checksum(data, parity.checksum_type), file_index, data, parity.checksum_type, parity.stream_id, compression)
+
+
+# receiving state of one sender, its streams and the objects it sends
+class ReceiverSession(object):
+    def __init__(self, addr, workers=None) -> None:
+        self.addr = addr
+        # receiving state of the streams by stream id, a stream starts with its first packet
+        self.streams = {}
+        self.writer = ObjectWriter(session_dir(addr), workers)
+        self.start_time = time.time()
+        self.last_seen = self.start_time
+        self.finished = False
+        # the packets are kept for rebuilding once the sender is seen to send parities
+        self.fec = False
+        # the answer to the RESUME packet of the sender, sent again if the sender repeats it
+        self.resume_reply = None
+        # closed when finished, dropped or when a restarted sender took the transfer over
+        self.closed = False
+    # handles a packet of the sender and returns the packet to answer with, if any
+    def receive(self, packet):
+        # the sender only sends ACK packets to probe the path mtu
+        if packet.packet_type == PacketType.ACK:
+            return make_probe_ack(packet)
+        if packet.packet_type == PacketType.RESUME:
+            return self.resume(packet)
+        if packet.stream_id not in self.streams:
+            self.streams[packet.stream_id] = StreamReceiver()
+        stream = self.streams[packet.stream_id]
+        # the sequence numbers are compared as unbounded integers from here on
+        packet.sequence_num = unwrap_seq(packet.sequence_num, stream.expected_seq_num)
+
+        if packet.packet_type == PacketType.PARITY:
+            self.fec = True
+            return self.receive_parity(packet, stream)
+
+        # Check for packet duplication
+        if packet.sequence_num < stream.expected_seq_num:
+            # duplicate packet is received, send an ack message and discard it. 
+            metrics.count("duplicates")
+            metrics.trace("duplicate", packet.stream_id, packet.sequence_num)
+            return make_ack(packet, stream)
+
+        # if the packet is data-containing packet
+        if packet.packet_type in (PacketType.SEND_PACKET, PacketType.RESEND_PACKET, PacketType.OBJECT_END):
+            reply = self.receive_data(packet, stream)
+            if self.fec:
+                # the packet may leave a single lost packet in a block whose parity is waiting
+                for start, parity in list(stream.parities.items()):
+                    if start <= packet.sequence_num < start + parity.file_index:
+                        reply = self.receive_parity(parity, stream) or reply
+                self.trim_fec(stream)
+            return reply
+        # if it is of FIN type, answer with a FIN_ACK and finish the session
+        print(f"received packet with type :{packet.packet_type}")
+        self.finished = True
+        return make_fin_ack(packet, stream.expected_seq_num)
+    # the sender names its transfer and lists its objects before sending the data, the objects are written to the directory
+    # of the transfer and the objects it is missing or holds stale copies of are sent back with the offsets
+    # to continue the partial ones from, the sender skips the other objects of its manifest
+    def resume(self, packet):
+        if self.resume_reply is None:
+            data = bytes(packet.raw_data)
+            if len(data) < TRANSFER_ID_SIZE or (len(data) - TRANSFER_ID_SIZE) % MANIFEST_ENTRY.size or self.writer.files:
+                return None
+            manifest = {(data_type, file_index): (size, digest.hex()) for data_type, file_index, size, digest in MANIFEST_ENTRY.iter_unpack(data[TRANSFER_ID_SIZE:])}
+            directory = transfer_dir(self.addr, data[:TRANSFER_ID_SIZE])
+            owner = active_transfers.get(directory)
+            if owner is not None:
+                # the directory is named by the ip of the sender and the transfer id, so the owner is the same sender
+                # from before a restart, its session is checkpointed and closed so the transfer continues from the journal
+                if not owner.closed:
+                    print(f"transfer taken over: {owner.addr} -> {self.addr}")
+                    owner.close()
+                # the journal is read once the owner has written it, till then the RESUME is not answered
+                # and the sender repeats it, the other sessions are not held up by the tasks of the owner
+                if not owner.writer.closed.is_set():
+                    return None
+            active_transfers[directory] = self
+            offsets = self.writer.resume(directory, manifest)
+            self.resume_reply = make_resume_reply(packet, offsets)
+            print(f"transfer resumed: {len(manifest) - len(offsets)} of {len(manifest)} objects held")
+        return self.resume_reply
+    # rebuilds the lost packet of the block of the parity if it is the only one missing and handles it like a received one,
+    # the parity is kept while more packets of its block are missing
+    def receive_parity(self, parity, stream):
+        start, count = parity.sequence_num, parity.file_index
+        stream.parities.pop(start, None)
+        missing = [seq_num for seq_num in range(start, start + count) if seq_num not in stream.recent]
+        reply = None
+        if len(missing) == 1 and missing[0] >= stream.expected_seq_num:
+            record = bytes(parity.raw_data)
+            for seq_num in range(start, start + count):
+                if seq_num != missing[0]:
+                    record = xor_bytes(record, fec_record(stream.recent[seq_num]))
+            rebuilt = packet_from_record(record, missing[0], parity)
+            if rebuilt is not None:
+                metrics.count("fec_rebuilt")
+                metrics.trace("fec_rebuilt", parity.stream_id, missing[0])
+                reply = self.receive_data(rebuilt, stream)
+            stream.fec_resolved = max(stream.fec_resolved, start + count)
+        elif not missing:
+            stream.fec_resolved = max(stream.fec_resolved, start + count)
+        elif start + count > stream.expected_seq_num:
+            # the parity waits for the late packets, so it is copied out of the reused receive buffer like the data
+            parity.raw_data = bytes(parity.raw_data)
+            stream.parities[start] = parity
+        self.trim_fec(stream)
+        return reply
+    # drops the kept packets no waiting block needs anymore and the parities of delivered blocks
+    def trim_fec(self, stream):
+        keep_from = min([stream.expected_seq_num, stream.fec_resolved, *stream.parities])
+        keep_from = max(keep_from, stream.expected_seq_num - FEC_MAX_BLOCK_SIZE)
+        while stream.recent and next(iter(stream.recent)) < keep_from:
+            del stream.recent[next(iter(stream.recent))]
+        for start, parity in list(stream.parities.items()):
+            if start + parity.file_index <= stream.expected_seq_num:
+                del stream.parities[start]
+    # handles a data packet which is not a duplicate and returns the ack for it, if any
+    def receive_data(self, packet, stream):
+        if self.fec and packet.sequence_num < stream.expected_seq_num + window_size:
+            # the data is copied out of the receive buffer which is reused for the next batch
+            packet.raw_data = bytes(packet.raw_data)
+            stream.recent[packet.sequence_num] = packet
+        # Check if the received packet has the expected sequence number
+        if protocol_mode == "sr":
+            if packet.sequence_num < stream.expected_seq_num + window_size:
+                # buffer every packet in the window till the gap before it is filled, the data of a packet
+                # ahead of the expected one is copied out of the receive buffer which is reused for the next batch
+                if packet.sequence_num != stream.expected_seq_num:
+                    packet.raw_data = bytes(packet.raw_data)
+                    metrics.count("out_of_order_buffered")
+                stream.reorder_buffer[packet.sequence_num] = packet
+                # deliver the buffered packets which are now in order
+                while stream.expected_seq_num in stream.reorder_buffer:
+                    self.writer.deliver(stream.reorder_buffer.pop(stream.expected_seq_num))
+                    stream.expected_seq_num += 1
+                # acknowledge the packet on its own, together with the cumulative ack and the sack bitmap
+                return make_ack(packet, stream)
+            # packets beyond the window are discarded, the sender retransmits them after its timer expires
+            metrics.count("out_of_order_dropped")
+            metrics.trace("out_of_order", packet.stream_id, packet.sequence_num)
+            return None
+        elif packet.sequence_num == stream.expected_seq_num:
+            #write the data of the packet into its object file
+            self.writer.deliver(packet)
+            stream.expected_seq_num += 1  # move the sequence number window forward
+            # the packets kept for rebuilding which follow a rebuilt one are in order now
+            while stream.expected_seq_num in stream.recent:
+                self.writer.deliver(stream.recent[stream.expected_seq_num])
+                stream.expected_seq_num += 1
+            #send a packet with ACK message
+            return make_ack(packet, stream)
+        # packets larger than expected sequence number recieved, discard, and wait for client timeout event
+        metrics.count("out_of_order_dropped")
+        metrics.trace("out_of_order", packet.stream_id, packet.sequence_num)
+        return None
+    # the session keeps its directory in active_transfers till its writer is closed
+    def close(self, on_closed=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close(on_closed)
+
+
+# serves any number of senders at once, every datagram is handed to the session of its sender
+# a session is finished by the FIN of the sender and dropped when it is idle for SESSION_IDLE_TIMEOUT
+class UdpReceiver(object):
+    def __init__(self, udp_socket, done, workers=None) -> None:
+        self.udp_socket = udp_socket
+        self.done = done
+        # the object writers of all sessions share the workers
+        self.workers = workers
+        # a batch of datagrams is received into the buffers before it is handled
+        self.buffers = [bytearray(RECV_BUFFER_SIZE) for i in range(RECV_BATCH_SIZE)]
+        self.sessions = {}
+        # finished sessions whose objects are still written and verified by the workers, their FIN is answered
+        # once they are closed
+        self.closing = {}
+        # finished senders by the time they finished, a late FIN is answered again and late data packets
+        # are dropped instead of starting a new session over the written objects
+        self.finished = {}
+        loop = asyncio.get_running_loop()
+        loop.add_reader(udp_socket, self.read_ready)
+        self.eviction = loop.call_later(SESSION_IDLE_TIMEOUT / 2, self.evict_idle)
+    # receives the datagrams waiting on the socket, handles them and sends the coalesced acks
+    def read_ready(self):
+        datagrams = []
+        for buffer in self.buffers:
+            try:
+                n, addr = self.udp_socket.recvfrom_into(buffer)
+            except (BlockingIOError, InterruptedError):
                 break
-
-            
-
-        else:
-            # packet is corrupted
-            print(f"Corrupted packet received. Discarding.")
-    return 
-
-
-
-
-
-
-def reconstruct_original_files(data_chunks):
-    # sort data chunks based on their sequence numbers
-    sorted_chunks = sorted(data_chunks, key=lambda chunk: chunk.sequence_num)
-
-    # concatenate data chunks to reconstruct the original data
-    reconstructed_data = "".join(chunk.raw_data.decode('utf-8') for chunk in sorted_chunks)
-
-    return reconstructed_data
-
-def save_to_files(reconstructed_data, j, data_type):
-    # save the reconstructed data to the original files
-    if data_type == DataType.LARGE:
-        with open(f"large-{j}.obj", "w", encoding="utf-8") as file:
-            file.write(reconstructed_data)
-    else:
-        with open(f"small-{j}.obj", "w", encoding="utf-8") as file:
-            file.write(reconstructed_data)
+            except OSError as e:
+                print(f"Unexpected error: {e}")
+                break
+            datagrams.append((memoryview(buffer)[:n], addr))
+        metrics.count("packets_received", len(datagrams))
+        metrics.observe("receive_batch", len(datagrams))
+        acks = {}
+        # a later ack of the same stream in the batch covers the earlier ones only if it is cumulative or carries the
+        # sack bitmap, the individual acks of Selective Repeat without sack are all sent
+        coalesce = protocol_mode == "gbn" or sack_enabled
+        acks_sent = 0
+        for data, addr in datagrams:
+            reply = self.datagram_received(data, addr)
+            if reply is None:
+                continue
+            if reply.packet_type == PacketType.ACK and coalesce:
+                acks[(addr, reply.stream_id)] = reply
+                continue
+            self.udp_socket.sendto(reply.serialize(), addr)
+            if reply.packet_type == PacketType.ACK:
+                acks_sent += 1
+        for (addr, stream_id), ack_packet in acks.items():
+            self.udp_socket.sendto(ack_packet.serialize(), addr)
+        metrics.count("acks_sent", acks_sent + len(acks))
+    # handles a datagram and returns the packet to answer with, if any
+    def datagram_received(self, data, addr):
+        #check for packet corruption
+        packet = parse_packet(data)
+        if packet is None:
+            # packet is corrupted, it is counted while parsing
+            return None
+        if addr in self.sessions and self.sessions[addr].closed:
+            # the transfer of the session was taken over by the sender from a new address
+            del self.sessions[addr]
+            self.finished[addr] = time.time()
+        if addr in self.closing:
+            return None
+        if addr in self.finished:
+            if packet.packet_type == PacketType.FIN:
+                return make_fin_ack(packet, packet.sequence_num)
+            return None
+        session = self.sessions.get(addr)
+        if session is not None and packet.packet_type == PacketType.RESUME and session.streams:
+            # a sender restarted on the same address begins a new session, the old one is checkpointed
+            session.close()
+            session = None
+            print(f"session restarted: {addr}")
+        if session is None:
+            session = self.sessions[addr] = ReceiverSession(addr, self.workers)
+            print(f"session started: {addr}")
+        session.last_seen = time.time()
+        reply = session.receive(packet)
+        if session.finished:
+            del self.sessions[addr]
+            self.closing[addr] = session
+            loop = asyncio.get_running_loop()
+            session.close(lambda: loop.call_soon_threadsafe(self.session_closed, addr, session, reply))
+            return None
+        return reply
+    # answers the FIN of the sender once the objects of its session are written and verified
+    def session_closed(self, addr, session, fin_ack):
+        del self.closing[addr]
+        self.finished[addr] = time.time()
+        self.udp_socket.sendto(fin_ack.serialize(), addr)
+        print(f"session closed: {addr}")
+        print(f"total download time udp : {time.time() - session.start_time}")
+        if not serve_forever and not self.done.done():
+            self.done.set_result(None)
+    def evict_idle(self):
+        now = time.time()
+        for addr, session in list(self.sessions.items()):
+            if now - session.last_seen > SESSION_IDLE_TIMEOUT:
+                print(f"session idle, dropped: {addr}")
+                session.close()
+                del self.sessions[addr]
+        for addr, finished_time in list(self.finished.items()):
+            if now - finished_time > SESSION_IDLE_TIMEOUT:
+                del self.finished[addr]
+        for directory, session in list(active_transfers.items()):
+            if session.writer.closed.is_set():
+                del active_transfers[directory]
+        self.eviction = asyncio.get_running_loop().call_later(SESSION_IDLE_TIMEOUT / 2, self.evict_idle)
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.udp_socket)
+        self.eviction.cancel()
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+
+
+async def serve():
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    udp_socket.bind(server_address)
+    udp_socket.setblocking(False)
+    workers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix="verify") for i in range(verify_workers)]
+    receiver = UdpReceiver(udp_socket, done, workers)
+    metrics.start("udpserver")
+    print("server listening")
+    try:
+        await done
+    finally:
+        receiver.close()
+        udp_socket.close()
+        for worker in workers:
+            worker.shutdown()
+        metrics.stop()
 
 
+def gbn_receiver():
+    asyncio.run(serve())
 
 
 if __name__ == "__main__":
-    start = time.time()
-    # receive the packets and store it in a list
-    gbn_receiver()
-    #post-processing of received packets
-    j = 0
-    turn = 0
-    large_num = 0
-    small_num = 0
-    while j < len(out_of_order_packs):
-        if out_of_order_packs[j].data_type == DataType.LARGE:
-            # the received packet is large
-            large_num = out_of_order_packs[j].file_index # get the file number of the data
-            large_chunks = []
-            while j < len(out_of_order_packs) and out_of_order_packs[j].data_type == DataType.LARGE:
-            # add the data till a small packet is encountered
-                large_chunks.append(out_of_order_packs[j])
-                j += 1
-            # reconstruct the file object from the recieved chunks and save it
-            reconstructed_data = reconstruct_original_files(large_chunks)
-            save_to_files(reconstructed_data, large_num , DataType.LARGE)
-        else:
-        # if the received packet is small, store it till a large is encountered
-            small_num = out_of_order_packs[j].file_index
-            small_chunks = []
-            while j < len(out_of_order_packs) and out_of_order_packs[j].data_type == DataType.SMALL:
-                small_chunks.append(out_of_order_packs[j])
-                j += 1
-            reconstructed_data = reconstruct_original_files(small_chunks)
-            save_to_files(reconstructed_data, small_num , DataType.SMALL)
-    print("end of saving files")
-    end = time.time()
-    print(f"total download time udp : {end - start}")
-    
-
-    
-
-
-
-
-
+    # receive the packets and write the objects of every sender while they arrive
+    try:
+        gbn_receiver()
+    except KeyboardInterrupt:
+        pass
+    print("server stopped")